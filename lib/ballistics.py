@@ -0,0 +1,89 @@
+"This module smooths meter levels and tracks peak hold and clip latch for every bar"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# Needs numpy, without it the bars show the raw meter values as before.
+
+import math
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Ballistics:
+    """
+    Level, peak, peak age and clip latch for every meter bar in contiguous
+    arrays, advanced together once per display frame.
+
+    Levels rise towards the meter value with the attack time constant and fall
+    at release dB per second, peaks hold for hold seconds then fall at
+    peak_release dB per second, and a bar latches clip once its meter value
+    reaches clip dB until reset_clip is called.
+    """
+    def __init__(self, raw, attack=0.01, release=20.0, hold=1.5, peak_release=10.0,
+                 clip=-0.5, floor=-128.0):
+        """
+        raw is the array('h') of latest meter values in 1/256 dB, read in place
+        on every advance.
+        """
+        self.raw = numpy.frombuffer(raw, dtype=numpy.int16)
+        size = len(self.raw)
+        self.attack = attack
+        self.release = release
+        self.hold = hold
+        self.peak_release = peak_release
+        self.clip_db = clip
+        self.floor = floor
+        self.level = numpy.full(size, floor)
+        self.peak = numpy.full(size, floor)
+        self.peak_age = numpy.zeros(size)
+        self.clip = numpy.zeros(size, dtype=bool)
+        # what was last handed to the display, in 1/16 dB table steps
+        self.shown_level = numpy.full(size, -1, dtype=numpy.int32)
+        self.shown_peak = numpy.full(size, -1, dtype=numpy.int32)
+        self.shown_clip = numpy.zeros(size, dtype=bool)
+
+    @staticmethod
+    def available():
+        "True if numpy is installed"
+        return numpy is not None
+
+    def reset_clip(self):
+        self.clip[:] = False
+
+    def advance(self, dt):
+        """
+        Move every bar on by dt seconds, returns the indices of bars whose
+        displayed level, peak or clip changed.
+        """
+        np = numpy
+        target = self.raw / 256.0
+        rising = target > self.level
+        coef = 1.0 - math.exp(-dt / self.attack) if self.attack > 0 else 1.0
+        self.level = np.where(rising, self.level + (target - self.level) * coef,
+                              np.maximum(target, self.level - self.release * dt))
+
+        above = self.level >= self.peak
+        self.peak_age = np.where(above, 0.0, self.peak_age + dt)
+        falling = np.maximum(self.level, self.peak - self.peak_release * dt)
+        self.peak = np.where(above, self.level,
+                             np.where(self.peak_age > self.hold, falling, self.peak))
+        self.clip |= target >= self.clip_db
+
+        level = (self.level * 16).astype(np.int32)
+        peak = (self.peak * 16).astype(np.int32)
+        changed = np.flatnonzero((level != self.shown_level) | (peak != self.shown_peak) |
+                                 (self.clip != self.shown_clip))
+        self.shown_level = level
+        self.shown_peak = peak
+        self.shown_clip = self.clip.copy()
+        return changed
+
+    def raw_level(self, index):
+        "displayed level of a bar as a raw meter value"
+        return int(self.level[index] * 256)
+
+    def raw_peak(self, index):
+        "displayed peak of a bar as a raw meter value"
+        return int(self.peak[index] * 256)
@@ -0,0 +1,109 @@
+"This module benchmarks the display end to end against the mixer simulator"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# Run from the top of the tree so xrem.kv is found:
+#   python -m lib.benchmark --rate 20 --rate 100 --rate 400
+
+import os
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import argparse
+import asyncio
+import threading
+import time
+from kivy.clock import Clock
+from kivy.lang import Builder
+from lib.simulator import serve
+import main
+
+class BenchGUI(main.XRemGUI):
+    "XRemGUI timing the connection and every meter packet from arrival to display"
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.channel_data = []
+        self.connect_start = None
+        self.connect_time = None
+        self.received = 0
+        self.arrivals = []
+        self.latencies = []
+
+    def sync_done(self, failed):
+        self.connect_time = time.perf_counter() - self.connect_start
+        super().sync_done(failed)
+
+    def meter_handler(self, routes, blob):
+        self.received += 1
+        self.arrivals.append(time.perf_counter())
+        super().meter_handler(routes, blob)
+
+    def apply_meters(self, dt):
+        (arrivals, self.arrivals) = (self.arrivals, [])
+        super().apply_meters(dt)
+        now = time.perf_counter()
+        self.latencies.extend(now - arrival for arrival in arrivals)
+
+def percentile(values, fraction):
+    "value below which fraction of the sorted values lie"
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run(rate, seconds, meter_bridge):
+    "benchmark one meter rate, returns a dict of results"
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    (transport, simulator) = asyncio.run_coroutine_threadsafe(
+        serve('127.0.0.1', 0, rate=rate), loop).result()
+
+    gui = BenchGUI()
+    gui.paint_buttons(meter_bridge=meter_bridge)
+    gui.xair_address = '127.0.0.1'
+    gui.xair_port = transport.get_extra_info('sockname')[1]
+    gui.connect_start = time.perf_counter()
+    gui.connect_mixer(True)
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        Clock.tick()
+    # stop the meters then let the last datagrams arrive before counting
+    loop.call_soon_threadsafe(transport.close)
+    time.sleep(0.2)
+    Clock.tick()
+    gui.connect_mixer(False)
+    Clock.unschedule(gui.apply_meters)
+    loop.call_soon_threadsafe(loop.stop)
+
+    latencies = sorted(gui.latencies)
+    return {
+        'rate': rate,
+        'connect': gui.connect_time,
+        'sent': simulator.sent,
+        'received': gui.received,
+        'per_second': gui.received / seconds,
+        'p50': percentile(latencies, .5),
+        'p90': percentile(latencies, .9),
+        'p99': percentile(latencies, .99),
+        'max': latencies[-1] if latencies else float('nan'),
+    }
+
+def main_bench():
+    parser = argparse.ArgumentParser(description='End to end display benchmark')
+    parser.add_argument('--rate', type=float, action='append',
+                        help='meter packets per second per bank, repeat to sweep')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--meter-bridge', action='store_true')
+    args = parser.parse_args()
+    Builder.load_file('xrem.kv')
+    print('%8s %10s %8s %8s %8s %8s %8s %8s %8s' % ('rate', 'connect s', 'pkt/s', 'dropped',
+          'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'result'))
+    for rate in args.rate or [20]:
+        result = run(rate, args.seconds, args.meter_bridge)
+        dropped = result['sent'] - result['received']
+        print('%8.0f %10.3f %8.1f %8d %8.2f %8.2f %8.2f %8.2f %8s' % (
+            rate, result['connect'] or float('nan'), result['per_second'], dropped,
+            result['p50'] * 1000, result['p90'] * 1000, result['p99'] * 1000,
+            result['max'] * 1000, 'ok' if dropped == 0 else 'DROPS'))
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,131 @@
+"This module records received OSC datagrams to a file and plays them back"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# The file is an 8 byte magic followed by one record per datagram, a little
+# endian double of time.monotonic() seconds and a 32 bit length then the
+# datagram itself.
+
+import asyncio
+import mmap
+import struct
+import sys
+import time
+
+MAGIC = b'XRCAP\x00\x01\x00'
+RECORD = struct.Struct('<dI')
+_YIELD_EVERY = 64       # datagrams replayed between turns of the event loop when not waiting
+
+class CaptureWriter:
+    "Appends datagrams with their arrival time to a capture file"
+    def __init__(self, path):
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.count = 0
+
+    def write(self, data):
+        "record one datagram, called from the OSC receive path"
+        self.file.write(RECORD.pack(time.monotonic(), len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def close(self):
+        self.file.close()
+
+class CaptureReader:
+    "Memory maps a capture file and iterates over its datagrams"
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map.close()
+            raise ValueError('%s is not an OSC capture file' % path)
+
+    def __iter__(self):
+        "yield (capture time, datagram) in recorded order"
+        view = memoryview(self.map)
+        offset = len(MAGIC)
+        end = len(view) - RECORD.size
+        try:
+            while offset <= end:
+                (stamp, size) = RECORD.unpack_from(view, offset)
+                offset += RECORD.size
+                if offset + size > len(view):
+                    break   # truncated by a crash while capturing
+                yield (stamp, bytes(view[offset:offset + size]))
+                offset += size
+        finally:
+            view.release()
+
+    def close(self):
+        self.map.close()
+
+def replay(path, deliver, speed=1.0):
+    """
+    Call deliver(datagram) for each captured datagram, spaced by the original
+    arrival times divided by speed, or as fast as possible if speed is 0.
+    """
+    reader = CaptureReader(path)
+    start = None
+    try:
+        for (stamp, data) in reader:
+            if speed:
+                if start is None:
+                    start = (stamp, time.monotonic())
+                delay = (stamp - start[0]) / speed - (time.monotonic() - start[1])
+                if delay > 0:
+                    time.sleep(delay)
+            deliver(data)
+    finally:
+        reader.close()
+
+async def replay_async(path, deliver, speed=1.0):
+    """
+    replay for an asyncio event loop, the loop keeps running between datagrams
+    and flat out or behind time gets a turn every _YIELD_EVERY datagrams
+    """
+    reader = CaptureReader(path)
+    loop = asyncio.get_running_loop()
+    start = None
+    unawaited = 0
+    try:
+        for (stamp, data) in reader:
+            delay = 0
+            if speed:
+                if start is None:
+                    start = (stamp, loop.time())
+                delay = (stamp - start[0]) / speed - (loop.time() - start[1])
+            if delay > 0:
+                await asyncio.sleep(delay)
+                unawaited = 0
+            else:
+                unawaited += 1
+                if unawaited >= _YIELD_EVERY:
+                    await asyncio.sleep(0)   # let other tasks and a cancel in
+                    unawaited = 0
+            deliver(data)
+    finally:
+        reader.close()
+
+def summary(path):
+    "print the datagram count, duration and address mix of a capture"
+    counts = {}
+    first = last = None
+    total = 0
+    reader = CaptureReader(path)
+    for (stamp, data) in reader:
+        first = stamp if first is None else first
+        last = stamp
+        address = data[:data.find(b'\0')].decode('ascii', 'replace')
+        counts[address] = counts.get(address, 0) + 1
+        total += 1
+    reader.close()
+    duration = (last - first) if total else 0
+    print('%d datagrams over %.1f s' % (total, duration))
+    for (address, count) in sorted(counts.items(), key=lambda item: -item[1]):
+        print('%8d %s' % (count, address))
+
+if __name__ == '__main__':
+    summary(sys.argv[1])
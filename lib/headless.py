@@ -0,0 +1,253 @@
+"This module runs the meter engine without Kivy, for a Pi Zero or as a service"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# Run from the top of the tree:
+#   python -m lib.headless --json --rate 5
+#   python -m lib.headless --mixer 192.168.1.20      (curses meter bridge)
+
+import argparse
+import contextlib
+import io
+import json
+import resource
+import sys
+import time
+from lib.meters import METER_ROUTES, MeterBuffer, MeterScale, decode_meters
+from lib.mixer import FORMATS, MixerState, display_params, strip_labels
+
+class Strip:
+    "What one strip shows, the plain counterpart of the ChannelData widget"
+    __slots__ = ('in_text', 'out_text', 'color', 'gain', 'mgain', 'thr', 'ratio')
+
+    def __init__(self, in_text, out_text):
+        self.in_text = in_text
+        self.out_text = out_text
+        self.color = 0
+        self.gain = self.mgain = self.thr = self.ratio = ""
+
+class MeterEngine:
+    """
+    State object of an XAirClient keeping the meters and the strip parameters
+    in plain objects for an output to read at its own rate, the same routing
+    and decoding as XRemGUI without any widgets.
+    """
+    def __init__(self):
+        self.strips = [Strip(left, right) for (left, right) in strip_labels()]
+        self.meter_buffer = MeterBuffer(len(self.strips))
+        self.meter_routes = {}
+        for (bank, routes) in METER_ROUTES.items():
+            self.meter_routes[bank] = [(i, strip * 3 + slot) for (i, strip, slot) in routes]
+        params = display_params()
+        self.mixer_state = MixerState(params)
+        self.param_targets = [tuple((self.strips[strip], attr, FORMATS[kind])
+                                    for (strip, attr, kind) in targets)
+                              for targets in params.values()]
+        self.status = 'Connecting'
+        self.failed = False
+
+    def osc_routes(self):
+        "(exact OSC address, handler, leading handler arguments) for the XAirClient routing index"
+        for (bank, routes) in self.meter_routes.items():
+            yield ('/meters/%d' % bank, self.meter_handler, (routes,))
+        for (address, slot) in self.mixer_state.slots.items():
+            yield (address, self.mixer_state.set, (slot,))
+
+    def meter_handler(self, routes, blob):
+        self.meter_buffer.store(routes, decode_meters(blob))
+
+    def received_meters(self, addr, *data):
+        pass      # every bank shown is routed
+
+    def connected(self, info):
+        self.status = '%s %s' % (info[1], info[0])
+
+    def sync_progress(self, done, total):
+        pass
+
+    def sync_done(self, failed):
+        pass
+
+    def connect_failed(self):
+        self.failed = True
+
+    def apply_params(self):
+        "format the changed parameters onto the strips, returns {address: raw value}"
+        changed = {}
+        targets = self.param_targets
+        for (slot, value) in self.mixer_state.changes():
+            if value != "":
+                for (strip, attr, fmt) in targets[slot]:
+                    setattr(strip, attr, fmt(value))
+                changed[self.mixer_state.addresses[slot]] = value
+        return changed
+
+def usage(started):
+    "peak RSS and CPU time used since started, a time.monotonic()"
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    elapsed = max(time.monotonic() - started, 1e-9)
+    return 'RSS peak %.1f MB, CPU %.2f s, %.1f%% of %.0f s' % (
+        rusage.ru_maxrss / 1024, cpu, 100 * cpu / elapsed, elapsed)
+
+class JsonOutput:
+    """
+    Newline delimited JSON, one object per frame with new meters or parameters:
+    t in seconds, db the level of every bar, three per strip, params the raw
+    values changed by OSC address and strips the labels when they change.
+    """
+    def __init__(self, engine, file=sys.stdout):
+        self.engine = engine
+        self.file = file
+        self.labels = None
+        self.quit = False
+
+    def frame(self, now):
+        engine = self.engine
+        buffer = engine.meter_buffer
+        record = {'t': round(now, 3)}
+        params = engine.apply_params()
+        if params:
+            record['params'] = params
+        labels = [(strip.in_text, strip.out_text) for strip in engine.strips]
+        if labels != self.labels:
+            record['strips'] = self.labels = labels
+        if any(buffer.dirty):
+            buffer.clear()
+            record['db'] = [round(value / 256, 1) for value in buffer.values]
+        if len(record) > 1:
+            self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.file.flush()
+
+class CursesOutput:
+    "A meter bridge in the terminal, one row of three bars per strip, q quits"
+    # bar colors as curses color pair numbers, the same thresholds as the display
+    scale = MeterScale(1, hot=(-7, 2), low=((-17, 3), (-27, 3)), shift=35)
+
+    def __init__(self, engine, screen, started):
+        import curses
+        self.curses = curses
+        self.engine = engine
+        self.screen = screen
+        self.started = started
+        self.quit = False
+        screen.nodelay(True)
+        try:
+            curses.curs_set(0)
+        except curses.error:
+            pass
+        self.colors = curses.has_colors()
+        if self.colors:
+            curses.start_color()
+            curses.init_pair(1, curses.COLOR_GREEN, curses.COLOR_BLACK)
+            curses.init_pair(2, curses.COLOR_RED, curses.COLOR_BLACK)
+            curses.init_pair(3, curses.COLOR_BLUE, curses.COLOR_BLACK)
+
+    def frame(self, now):
+        curses = self.curses
+        if self.screen.getch() in (ord('q'), ord('Q')):
+            self.quit = True
+            return
+        engine = self.engine
+        engine.apply_params()
+        engine.meter_buffer.clear()
+        values = engine.meter_buffer.values
+        scale = self.scale
+        (rows, cols) = self.screen.getmaxyx()
+        width = max((cols - 40) // 3, 4)
+        self.screen.erase()
+        self.add(0, 0, '%s   %s   q quits' % (engine.status, usage(self.started)))
+        for (row, strip) in enumerate(engine.strips[:rows - 2]):
+            self.add(row + 2, 0, '%-8.8s %-8.8s' % (strip.in_text, strip.out_text))
+            for slot in range(3):
+                i = scale.index(values[row * 3 + slot])
+                bar = int(scale.fraction[i] * width)
+                x = 18 + slot * (width + 1)
+                attr = curses.color_pair(scale.color[i]) if self.colors else 0
+                self.add(row + 2, x, '#' * min(bar, width), attr)
+                self.add(row + 2, x + min(bar, width), '.' * (width - min(bar, width)))
+            self.add(row + 2, 18 + 3 * (width + 1),
+                     '%-9s %s %s %s %s' % (scale.label[scale.index(values[row * 3 + 1])],
+                                           strip.gain, strip.mgain, strip.thr, strip.ratio))
+        self.screen.refresh()
+
+    def add(self, row, col, text, attr=0):
+        "write text, clipped at the edge of the terminal"
+        try:
+            self.screen.addstr(row, col, text, attr)
+        except self.curses.error:
+            pass
+
+def run(engine, output, rate, seconds=None):
+    "drive output rate times a second until quit, the connection fails or seconds pass"
+    period = 1 / rate
+    start = time.monotonic()
+    next_time = start
+    while not (output.quit or engine.failed):
+        now = time.monotonic()
+        if seconds is not None and now - start >= seconds:
+            break
+        output.frame(now - start)
+        next_time += period
+        time.sleep(max(0, next_time - time.monotonic()))
+
+def connect(engine, args):
+    "start an XAirClient feeding engine as the options ask, returns it or None"
+    from lib.xair import XAirClient, find_mixers, initial_queries
+    from lib.subscriptions import format_groups
+    if args.replay is not None:
+        client = XAirClient('127.0.0.1', engine)
+        client.start_replay(args.replay, args.speed)
+        engine.status = 'Replay %s' % args.replay
+        return client
+    if args.mixer is not None:
+        (host, _, port) = args.mixer.partition(':')
+        port = int(port) if port else XAirClient.XAIR_PORT
+    else:
+        mixers = find_mixers()
+        if not mixers:
+            return None
+        (host, port) = (mixers[0][0], XAirClient.XAIR_PORT)
+    client = XAirClient(host, engine, port)
+    client.queries = initial_queries()
+    client.formats = format_groups(engine.mixer_state)
+    client.start_connection()
+    return client
+
+def main():
+    parser = argparse.ArgumentParser(description='Meter engine without a display')
+    parser.add_argument('--mixer', metavar='HOST[:PORT]',
+                        help='mixer or relay to connect to, searched for if not given')
+    parser.add_argument('--replay', metavar='FILE', help='play an OSC capture instead')
+    parser.add_argument('--speed', type=float, default=1.0)
+    parser.add_argument('--json', action='store_true',
+                        help='write newline delimited JSON to stdout instead of a meter bridge')
+    parser.add_argument('--rate', type=float, default=10, help='output frames per second')
+    parser.add_argument('--seconds', type=float, help='stop after this long')
+    args = parser.parse_args()
+    started = time.monotonic()
+    engine = MeterEngine()
+    # keep the connection messages out of the JSON and off the meter bridge
+    log = sys.stderr if args.json else io.StringIO()
+    with contextlib.redirect_stdout(log):
+        client = connect(engine, args)
+        if client is None:
+            return
+        try:
+            if args.json:
+                run(engine, JsonOutput(engine, sys.__stdout__), args.rate, args.seconds)
+            else:
+                import curses
+                curses.wrapper(lambda screen: run(engine, CursesOutput(engine, screen, started),
+                                                  args.rate, args.seconds))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            client.stop_server()
+    if not args.json:
+        sys.stderr.write(log.getvalue())
+    print(usage(started), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
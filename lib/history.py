@@ -0,0 +1,185 @@
+"This module keeps a bounded history of the meter values for overviews and summaries"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import time
+from array import array
+
+FLOOR = -32768
+
+class _Tier:
+    "Ring of min/max/mean per meter, each entry summarising a fixed number of frames"
+    def __init__(self, meters, frames, capacity):
+        self.frames = frames       # entries of the tier below per entry
+        self.capacity = capacity
+        self.pos = 0               # next entry to write
+        self.filled = 0
+        # meter major so the history of one meter is a contiguous slice
+        self.min = array('h', [FLOOR]) * (meters * capacity)
+        self.max = array('h', [FLOOR]) * (meters * capacity)
+        self.mean = array('h', [FLOOR]) * (meters * capacity)
+        # the entry being built
+        self.acc_min = array('h', [32767]) * meters
+        self.acc_max = array('h', [FLOOR]) * meters
+        self.acc_sum = array('d', [0.0]) * meters
+        self.acc_count = 0
+
+    def slices(self, meter, entries):
+        "(start, end) ranges holding the newest entries of a meter, oldest first"
+        entries = min(entries, self.filled)
+        base = meter * self.capacity
+        start = self.pos - entries
+        if start >= 0:
+            return [(base + start, base + self.pos)]
+        return [(base + self.capacity + start, base + self.capacity), (base, base + self.pos)]
+
+class MeterHistory:
+    """
+    History of every meter buffer value with a bounded, preallocated footprint.
+
+    The newest seconds are kept at the full meter rate, older values are
+    summarised as min/max/mean in cascaded tiers, each entry of a tier covering
+    a fixed number of entries of the one before. Time is counted in recorded
+    frames, taken at most rate times a second while meters arrive.
+    """
+    def __init__(self, meters, rate=20, seconds=300, tiers=((1, 3600), (10, 2160))):
+        """
+        meters is the number of values recorded per frame, tiers is a list of
+        (seconds per entry, entries), by default an hour at 1 s then six hours
+        at 10 s.
+        """
+        self.meters = meters
+        self.rate = rate
+        self.period = 1 / rate
+        self.next_time = 0.0
+        self.capacity = int(rate * seconds)
+        self.full = array('h', [FLOOR]) * (meters * self.capacity)
+        self.pos = 0
+        self.filled = 0
+        self.tiers = []
+        previous = 1 / rate
+        for (period, entries) in tiers:
+            self.tiers.append(_Tier(meters, int(round(period / previous)), entries))
+            previous = period
+        self.tier_seconds = [period for (period, entries) in tiers]
+
+    def record(self, values, now=None):
+        """
+        Record values, an array of raw meter values, if a frame is due. Called
+        for every meter packet so the frame rate is capped at rate.
+        """
+        now = time.monotonic() if now is None else now
+        if now < self.next_time:
+            return
+        self.next_time = max(self.next_time + self.period, now)
+        capacity = self.capacity
+        full = self.full
+        pos = self.pos
+        for meter in range(self.meters):
+            full[meter * capacity + pos] = values[meter]
+        self.pos = (pos + 1) % capacity
+        self.filled = min(self.filled + 1, capacity)
+        self._fold(0, values, values, values, 0, 1)
+
+    def _fold(self, level, mins, maxs, means, offset, stride):
+        """
+        fold one entry into tier level, the value of meter m is at index
+        m * stride + offset of mins, maxs and means
+        """
+        if level >= len(self.tiers):
+            return
+        tier = self.tiers[level]
+        acc_min = tier.acc_min
+        acc_max = tier.acc_max
+        acc_sum = tier.acc_sum
+        index = offset
+        for meter in range(self.meters):
+            if mins[index] < acc_min[meter]:
+                acc_min[meter] = mins[index]
+            if maxs[index] > acc_max[meter]:
+                acc_max[meter] = maxs[index]
+            acc_sum[meter] += means[index]
+            index += stride
+        tier.acc_count += 1
+        if tier.acc_count >= tier.frames:
+            self._complete(level)
+
+    def _complete(self, level):
+        "write the entry built in tier level and feed it to the next tier"
+        tier = self.tiers[level]
+        capacity = tier.capacity
+        pos = tier.pos
+        count = tier.acc_count
+        acc_min = tier.acc_min
+        acc_max = tier.acc_max
+        acc_sum = tier.acc_sum
+        for meter in range(self.meters):
+            index = meter * capacity + pos
+            tier.min[index] = acc_min[meter]
+            tier.max[index] = acc_max[meter]
+            tier.mean[index] = int(acc_sum[meter] / count)
+            acc_min[meter] = 32767
+            acc_max[meter] = FLOOR
+            acc_sum[meter] = 0.0
+        tier.acc_count = 0
+        tier.pos = (pos + 1) % capacity
+        tier.filled = min(tier.filled + 1, capacity)
+        self._fold(level + 1, tier.min, tier.max, tier.mean, pos, capacity)
+
+    def _source(self, seconds):
+        "the finest (tier, entries) covering the last seconds, None for full rate"
+        if seconds <= self.capacity / self.rate:
+            return (None, max(1, int(seconds * self.rate)))
+        for (tier, period) in zip(self.tiers, self.tier_seconds):
+            if seconds <= tier.capacity * period:
+                return (tier, max(1, int(seconds / period)))
+        tier = self.tiers[-1]
+        return (tier, tier.capacity)
+
+    def _slices(self, meter, seconds):
+        (tier, entries) = self._source(seconds)
+        if tier is None:
+            entries = min(entries, self.filled)
+            base = meter * self.capacity
+            start = self.pos - entries
+            if start >= 0:
+                ranges = [(base + start, base + self.pos)]
+            else:
+                ranges = [(base + self.capacity + start, base + self.capacity),
+                          (base, base + self.pos)]
+            return (self.full, self.full, self.full, ranges)
+        return (tier.min, tier.max, tier.mean, tier.slices(meter, entries))
+
+    def window(self, meter, seconds):
+        "(min, max, mean) raw value of a meter over the last seconds, None if empty"
+        (mins, maxs, means, ranges) = self._slices(meter, seconds)
+        ranges = [(a, b) for (a, b) in ranges if b > a]
+        if not ranges:
+            return None
+        count = sum(b - a for (a, b) in ranges)
+        return (min(min(mins[a:b]) for (a, b) in ranges),
+                max(max(maxs[a:b]) for (a, b) in ranges),
+                int(sum(sum(means[a:b]) for (a, b) in ranges) / count))
+
+    def sparkline(self, meter, seconds, points):
+        "max raw value of a meter in each of points equal parts of the last seconds"
+        (mins, maxs, means, ranges) = self._slices(meter, seconds)
+        series = array('h')
+        for (a, b) in ranges:
+            series.extend(maxs[a:b])
+        if not series:
+            return []
+        step = len(series) / points
+        return [max(series[int(i * step):max(int((i + 1) * step), int(i * step) + 1)])
+                for i in range(points) if int(i * step) < len(series)]
+
+    def loudest(self, seconds, count=1):
+        "the count meters with the highest max over the last seconds as (max, meter)"
+        peaks = []
+        for meter in range(self.meters):
+            window = self.window(meter, seconds)
+            if window is not None and window[1] > FLOOR:
+                peaks.append((window[1], meter))
+        peaks.sort(reverse=True)
+        return peaks[:count]
@@ -0,0 +1,218 @@
+"This module draws a bank of channel meter strips from a single canvas"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+from kivy.uix.widget import Widget
+from kivy.graphics import Color, Rectangle
+from kivy.metrics import sp
+from kivy.clock import Clock
+from lib.textcache import texture_cache, rotated_coords
+
+# scale labels down the left column of each strip
+SCALE_TEXT = ["2", "7", "12", "17", "22", "27", "32"]
+# strip attributes shown in the middle and right columns, top to bottom
+MID_TEXT = ["mgain", "gain", "in_text", "level"]
+RIGHT_TEXT = ["ratio", "thr", "out_text", "level_out"]
+# text drawn in the strip color rather than white
+NAME_TEXT = ("in_text", "out_text")
+# bar color and height attributes, left to right
+BARS = [("in_color", "in_percent"), ("out_color", "out_percent"),
+        ("post_color", "post_percent")]
+# peak hold marker color and height attributes, left to right
+PEAKS = [("in_peak_color", "in_peak"), ("out_peak_color", "out_peak"),
+         ("post_peak_color", "post_peak")]
+WHITE = [1, 1, 1, 1]
+CLIP = [1, 0, 0, 1]
+
+class StripState:
+    """
+    Plain data for one strip drawn by a MeterBridge.
+
+    Has the same attributes and update methods as ChannelData so the handlers
+    in XRemGUI drive either, setting an attribute only marks the strip for the
+    next redraw.
+    """
+    def __init__(self, scale, in_text="Top", out_text="Mid", in_color=None,
+                 out_color=None, post_color=None, in_percent=1, out_percent=1,
+                 post_percent=0, color=None):
+        self._bridge = None
+        self._index = 0
+        self.scale = scale
+        self.in_text = in_text
+        self.out_text = out_text
+        self.in_color = in_color or [0, 0, .5, 1]
+        self.out_color = out_color or [.8, 0, 0, 1]
+        self.post_color = post_color or [0, .5, 0, 1]
+        self.in_percent = in_percent
+        self.out_percent = out_percent
+        self.post_percent = post_percent
+        self.in_peak = self.out_peak = self.post_peak = 0
+        self.in_peak_color = self.out_peak_color = self.post_peak_color = WHITE
+        self.gain = "0"
+        self.ratio = "0"
+        self.thr = "0"
+        self.mgain = "0"
+        self.color = color or [1, 1, 1, 1]
+        self.level = ""
+        self.level_out = ""
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[0] != '_' and self._bridge is not None:
+            self._bridge.dirty.add(self._index)
+
+    def update_in(self, value):
+        i = self.scale.index(value)
+        self.in_percent = self.scale.fraction[i]
+        self.in_color = self.scale.color[i]
+
+    def update_out(self, value):
+        i = self.scale.index(value)
+        self.out_percent = self.scale.fraction[i]
+        self.out_color = self.scale.color[i]
+        self.level = self.scale.label[i]
+
+    def update_post(self, value):
+        i = self.scale.index(value)
+        self.post_percent = self.scale.fraction[i]
+        self.post_color = self.scale.color[i]
+        self.level_out = self.scale.label[i]
+
+    def update_in_peak(self, value, clip):
+        self.in_peak = self.scale.fraction[self.scale.index(value)]
+        self.in_peak_color = CLIP if clip else WHITE
+
+    def update_out_peak(self, value, clip):
+        self.out_peak = self.scale.fraction[self.scale.index(value)]
+        self.out_peak_color = CLIP if clip else WHITE
+
+    def update_post_peak(self, value, clip):
+        self.post_peak = self.scale.fraction[self.scale.index(value)]
+        self.post_peak_color = CLIP if clip else WHITE
+
+    def updaters(self):
+        "update methods indexed by meter slot: in, out, post"
+        return (self.update_in, self.update_out, self.update_post)
+
+    def peak_updaters(self):
+        "peak update methods indexed by meter slot: in, out, post"
+        return (self.update_in_peak, self.update_out_peak, self.update_post_peak)
+
+class _Text:
+    "A rotated text rectangle and the text it currently shows"
+    def __init__(self, color):
+        self.text = None
+        self.color = Color(*color)
+        self.rect = Rectangle(size=(0, 0))
+        self.box = (0, 0, 0, 0)
+
+    def set_text(self, text, font_size):
+        "swap in the cached texture if the text changed, rotated by 90 degrees"
+        if text == self.text:
+            return
+        self.text = text
+        if text == "":
+            self.rect.size = (0, 0)
+            return
+        texture = texture_cache.get(text, font_size)
+        self.rect.texture = texture
+        self.rect.tex_coords = rotated_coords(texture)
+        self.rect.size = (texture.height, texture.width)
+        self.place()
+
+    def place(self):
+        "center the rectangle in its box"
+        (x, y, w, h) = self.box
+        (tw, th) = self.rect.size
+        self.rect.pos = (x + (w - tw) / 2, y + (h - th) / 2)
+
+class MeterBridge(Widget):
+    """
+    Draws a grid of strips with three bars and their labels from one canvas.
+
+    Replaces one ChannelData BoxLayout with 15 Labels per strip, the canvas
+    instructions are created once and updated in place when a strip changes.
+    """
+    def __init__(self, strips, cols, **kwargs):
+        super().__init__(**kwargs)
+        self.strips = strips
+        self.cols = cols
+        self.dirty = set(range(len(strips)))
+        self.font_size = sp(15)
+        self.bars = []   # [(Color, Rectangle) * 3] per strip
+        self.peaks = []  # [(Color, Rectangle) * 3] per strip
+        self.texts = []  # {name: _Text} per strip
+        with self.canvas:
+            for (index, strip) in enumerate(strips):
+                bars = []
+                for _ in BARS:
+                    bars.append((Color(1, 1, 1, 1), Rectangle(size=(0, 0))))
+                self.bars.append(bars)
+                peaks = []
+                for _ in PEAKS:
+                    peaks.append((Color(1, 1, 1, 1), Rectangle(size=(0, 0))))
+                self.peaks.append(peaks)
+                texts = {}
+                for name in MID_TEXT + RIGHT_TEXT:
+                    texts[name] = _Text(strip.color if name in NAME_TEXT else (1, 1, 1, 1))
+                for (row, text) in enumerate(SCALE_TEXT):
+                    texts[row] = _Text((1, 1, 1, 1))
+                self.texts.append(texts)
+                strip._index = index
+                strip._bridge = self
+        for texts in self.texts:
+            for (row, text) in enumerate(SCALE_TEXT):
+                texts[row].set_text(text, self.font_size)
+        self.bind(pos=self.layout, size=self.layout)
+        Clock.schedule_interval(self.redraw, 0) # once per frame
+
+    def layout(self, *args):
+        "position every strip in the grid and mark them all for redraw"
+        for (index, texts) in enumerate(self.texts):
+            (x, y, width, height) = self.strip_box(index)
+            third = width / 3
+            for row in range(len(SCALE_TEXT)):
+                cell = height / len(SCALE_TEXT)
+                texts[row].box = (x, y + height - (row + 1) * cell, third, cell)
+                texts[row].place()
+            for (col, names) in ((1, MID_TEXT), (2, RIGHT_TEXT)):
+                cell = height / len(names)
+                for (row, name) in enumerate(names):
+                    texts[name].box = (x + col * third, y + height - (row + 1) * cell,
+                                       third, cell)
+                    texts[name].place()
+        self.dirty.update(range(len(self.strips)))
+        self.redraw(0)
+
+    def strip_box(self, index):
+        "(x, y, width, height) of a strip"
+        rows = max(1, -(-len(self.strips) // self.cols))
+        width = self.width / self.cols
+        height = self.height / rows
+        return (self.x + (index % self.cols) * width,
+                self.top - (index // self.cols + 1) * height, width, height)
+
+    def redraw(self, dt):
+        "update the canvas instructions of strips changed since the last frame"
+        dirty = self.dirty
+        while dirty:
+            index = dirty.pop() # the OSC thread may add while this runs
+            strip = self.strips[index]
+            (x, y, width, height) = self.strip_box(index)
+            for (col, (color_name, percent_name)) in enumerate(BARS):
+                (color, rect) = self.bars[index][col]
+                color.rgba = getattr(strip, color_name)
+                rect.pos = (x + width * .1 + width * col / 3, y)
+                rect.size = (width / 3 * 0.8, height * getattr(strip, percent_name))
+            for (col, (color_name, peak_name)) in enumerate(PEAKS):
+                (color, rect) = self.peaks[index][col]
+                peak = getattr(strip, peak_name)
+                color.rgba = getattr(strip, color_name)
+                rect.pos = (x + width * .1 + width * col / 3, y + height * peak - 2)
+                rect.size = (width / 3 * 0.8, 2 if peak > 0 else 0)
+            texts = self.texts[index]
+            for name in MID_TEXT + RIGHT_TEXT:
+                texts[name].set_text(getattr(strip, name), self.font_size)
+            for name in NAME_TEXT:
+                texts[name].color.rgba = strip.color
@@ -0,0 +1,152 @@
+"This module decodes XAir /meters blobs and routes the values to the channel strips"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import struct
+from array import array
+from lib.stats import stats
+
+# slots within a strip, matching the three bars left to right
+IN = 0
+OUT = 1
+POST = 2
+
+_COUNT = struct.Struct("<L")
+_decoders = {}
+
+def decode_meters(blob):
+    """
+    Unpack a meters blob in one call.
+
+    The blob is a little endian 32 bit count followed by that many 16 bit signed
+    values in 1/256 dB steps.
+    """
+    count = _COUNT.unpack_from(blob, 0)[0]
+    decoder = _decoders.get(count)
+    if decoder is None:
+        decoder = _decoders[count] = struct.Struct("<%dh" % count)
+    if len(blob) < 4 + decoder.size: # truncated packet, decode what is there
+        count = (len(blob) - 4) // 2
+        return struct.unpack_from("<%dh" % count, blob, 4)
+    return decoder.unpack_from(blob, 4)
+
+def _bank_2():
+    "meters 2 input in, aux in, usb in"
+    routes = [(i, i, IN) for i in range(16)]  # 16 inputs
+    routes.append((16, 16, OUT))               # Aux L
+    routes.append((17, 16, POST))              # Aux R
+    return routes
+
+def _bank_5():
+    "meters 5 aux out, main out, ultranet out, usb out, phones out"
+    routes = []
+    for i in range(8):                         # 6 aux out and main L/R in pairs
+        routes.append((i, 17 + i // 2, POST if i % 2 else OUT))
+    for i in range(16):                        # ultranet out 1-16
+        routes.append((8 + i, i, POST))
+    for i in range(16):                        # usb out 1-16
+        routes.append((24 + i, i, OUT))
+    return routes
+
+# (value index, strip index, slot) for each meter bank that is displayed,
+# add a bank here to have received_meters display it
+METER_ROUTES = {
+    2: _bank_2(),
+    5: _bank_5(),
+}
+
+RTA_BANK = 4   # spectrum analyser bands, drawn by lib.spectrum
+
+class MeterScale:
+    """
+    Lookup tables from a raw meter value to bar height, bar color and dB label.
+
+    Meter values are 16 bit signed in 1/256 dB steps, the tables are indexed by
+    the value quantized to 1/16 dB which is well below the 0.1 dB shown. Colors
+    are shared objects from the caller and labels are interned so a lookup does
+    no arithmetic beyond the index and allocates nothing.
+    """
+    QUANTUM = 4                     # bits dropped from the raw value
+
+    def __init__(self, default_color, hot=None, low=(), shift=35, floor=-70):
+        """
+        default_color is used between the thresholds, hot is (dB, color) for
+        values above it and low is ((dB, color), ...) for values below each in
+        turn, the last matching wins. shift is the dB shown as an empty bar and
+        values below floor dB get an empty label.
+        """
+        self.fraction = []
+        self.color = []
+        self.label = []
+        labels = {}
+        for index in range(65536 >> self.QUANTUM):
+            value = ((index << self.QUANTUM) - 32768) / 256  # convert to DB
+            color = default_color
+            if hot is not None and value > hot[0]:
+                color = hot[1]
+            else:
+                for (threshold, low_color) in low:
+                    if value < threshold:
+                        color = low_color
+            self.color.append(color)
+            self.fraction.append(max(value + shift, 0) / shift)
+            text = "" if value < floor else f"{value:.1f} dB"
+            self.label.append(labels.setdefault(text, text))
+
+    def index(self, value):
+        "table index for a raw meter value"
+        return (value + 32768) >> self.QUANTUM
+
+class MeterBuffer:
+    """
+    Latest value store between the OSC server thread and the UI thread.
+
+    The network side only stores raw values and marks them dirty, the UI side
+    drains the dirty values once per frame. Single item writes to the array and
+    bytearray are atomic under the GIL so no lock is needed, a value written
+    while draining is at worst applied twice.
+    """
+    def __init__(self, strips, buffer=None, offset=0):
+        """
+        The values and dirty flags are held in buffer from offset if given, a
+        writable buffer such as shared memory shared with another process.
+        """
+        self.size = strips * 3
+        self.clean = bytes(self.size)
+        if buffer is None:
+            self.values = array('h', [-32768] * self.size)
+            self.dirty = bytearray(self.size)
+        else:
+            view = memoryview(buffer)
+            self.values = view[offset:offset + 2 * self.size].cast('h')
+            self.values[:] = array('h', [-32768] * self.size)
+            self.dirty = view[offset + 2 * self.size:offset + 3 * self.size]
+            self.dirty[:] = self.clean
+
+    def store(self, routes, values):
+        "store decoded values at their routed buffer index"
+        count = len(values)
+        buf = self.values
+        dirty = self.dirty
+        if stats.enabled:  # values replaced before the UI showed them
+            stats.count('meters coalesced', sum(dirty[index] for (i, index) in routes))
+        for (i, index) in routes:
+            if i < count:
+                buf[index] = values[i]
+                dirty[index] = 1
+
+    def clear(self):
+        "mark every value as applied, for readers of values that skip drain"
+        self.dirty[:] = self.clean
+
+    def drain(self):
+        "yield (buffer index, value) for each value changed since the last drain"
+        dirty = self.dirty
+        if not any(dirty):
+            return
+        buf = self.values
+        for index in range(self.size):
+            if dirty[index]:
+                dirty[index] = 0
+                yield (index, buf[index])
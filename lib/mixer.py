@@ -0,0 +1,162 @@
+"This module describes the XAir mixer parameters shown on the channel strips"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import json
+from lib.stats import stats
+
+ratios = [1.1, 1.3, 1.5, 2.0, 2.5, 3.0, 4.0, 5.0, 7.0, 10, 20, 100]
+
+def scale_fader(data):
+    "convert fader float to dB"
+    f = float(data)
+    if f < 0.0625:
+        d = (480 * f) - 90
+    elif f < 0.25:
+        d = (160 * f) - 70
+    elif f < 0.5:
+        d = (80 * f) - 50
+    else:
+        d = (40 * f) - 30
+    if d < -90:
+        d = -90
+    if d > 10:
+        d = 10
+    return d
+
+# parameter kind -> function formatting the raw OSC value for display,
+# color is left as the scribble strip color index for the UI to map
+FORMATS = {
+    'name': lambda v: v,
+    'aux_l': lambda v: "%s L" % v,
+    'aux_r': lambda v: "%s R" % v,
+    'color': lambda v: int(v) % 8,
+    'gain': lambda v: f"g {float(v)*72-12:.1f}",
+    'aux_gain': lambda v: f"g {float(v)*32-12:.1f}",
+    'mgain': lambda v: f"mg {float(v)*24:.1f}",
+    'thr': lambda v: f"th {float(v)*60-60:.1f}",
+    'ratio': lambda v: f"r {ratios[int(v)]}",
+    'fader': lambda v: f"f {scale_fader(v):.1f}",
+    'blank': lambda v: "",
+}
+
+def strip_labels():
+    "(left, right) label of each strip until the names are read from the mixer"
+    labels = [(f'{x+1}', f'Ch {x+1}') for x in range(16)]
+    labels.append(('Aux L', 'Aux R'))
+    labels.extend((f'Bus {2*x+1}', f'Bus {2*x+2}') for x in range(3))
+    labels.append(('Main L', 'Main R'))
+    return labels
+
+def bus_strip(bus):
+    "strip index and (left, right) attribute choice for output bus 1-6"
+    return (int((bus - 1) / 2) + 17, (bus - 1) % 2)
+
+def display_params():
+    """
+    Map each OSC address shown on the strips to its targets, a tuple of
+    (strip index, strip attribute, parameter kind).
+
+    Strips 0-15 are the input channels, 16 is the Aux input, 17-19 are the
+    output bus pairs and 20 is Main LR. The bus pairs show the dynamics of the
+    odd bus in the gain and mgain labels.
+    """
+    params = {}
+    for channel in range(1, 18):
+        ch = '/ch/{:0>2d}'.format(channel)
+        strip = channel - 1
+        params[ch + '/config/name'] = ((strip, 'in_text', 'name'),)
+        params[ch + '/config/color'] = ((strip, 'color', 'color'),)
+        params[ch + '/dyn/mgain'] = ((strip, 'mgain', 'mgain'),)
+        params[ch + '/dyn/thr'] = ((strip, 'thr', 'thr'),)
+        params[ch + '/dyn/ratio'] = ((strip, 'ratio', 'ratio'),)
+        params['/headamp/{:0>2d}/gain'.format(channel)] = \
+            ((strip, 'gain', 'gain' if channel < 17 else 'aux_gain'),)
+    for bus in range(1, 7):
+        prefix = '/bus/{:0>1d}'.format(bus)
+        (strip, right) = bus_strip(bus)
+        params[prefix + '/config/name'] = ((strip, 'out_text' if right else 'in_text', 'name'),)
+        if right:
+            params[prefix + '/dyn/mgain'] = ((strip, 'mgain', 'mgain'),)
+            params[prefix + '/dyn/thr'] = ((strip, 'thr', 'thr'),)
+            params[prefix + '/dyn/ratio'] = ((strip, 'ratio', 'ratio'),)
+        else:
+            params[prefix + '/dyn/mgain'] = ((strip, 'gain', 'mgain'),)
+            params[prefix + '/dyn/thr'] = ((strip, 'gain', 'thr'),)
+            params[prefix + '/dyn/ratio'] = ((strip, 'mgain', 'ratio'),)
+    params['/rtn/aux/config/name'] = ((16, 'in_text', 'aux_l'), (16, 'out_text', 'aux_r'))
+    params['/rtn/aux/mix/fader'] = ((16, 'mgain', 'fader'), (16, 'thr', 'blank'),
+                                    (16, 'ratio', 'blank'))
+    params['/lr/mix/fader'] = ((20, 'gain', 'fader'), (20, 'mgain', 'blank'))
+    params['/lr/dyn/thr'] = ((20, 'thr', 'thr'),)
+    params['/lr/dyn/ratio'] = ((20, 'ratio', 'ratio'),)
+    return params
+
+class MixerState:
+    """
+    Raw value of every parameter shown on the strips, one slot per OSC address.
+
+    The OSC thread stores received values with set, which only records a change
+    when the value differs from the one held, and the UI thread takes the slots
+    changed since it last looked with changes. A snapshot saved on quit and
+    loaded on the next start shows the last known state before the mixer answers.
+    """
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.slots = {address: slot for (slot, address) in enumerate(self.addresses)}
+        self.values = [None] * len(self.addresses)   # None until known
+        self.changed = set()   # slots not yet taken by changes
+
+    def set(self, slot, value, *data):
+        "store a received value, runs on the OSC thread"
+        if self.values[slot] == value:
+            if stats.enabled:
+                stats.count('params unchanged')
+            return
+        self.values[slot] = value
+        self.changed.add(slot)
+
+    def update(self, slots, values):
+        "store a block of received values, runs on the OSC thread"
+        held = self.values
+        changed = self.changed
+        for (slot, value) in zip(slots, values):
+            if held[slot] != value:
+                held[slot] = value
+                changed.add(slot)
+
+    def changes(self):
+        "yield (slot, value) for every slot changed since the last call"
+        changed = self.changed
+        while changed:     # pop rather than iterate, set may add meanwhile
+            slot = changed.pop()
+            yield (slot, self.values[slot])
+
+    def known(self, address):
+        "True if a value is held for address"
+        slot = self.slots.get(address)
+        return slot is not None and self.values[slot] is not None
+
+    def save(self, path):
+        "write the known values to path as JSON"
+        snapshot = {address: value for (address, value) in zip(self.addresses, self.values)
+                    if value is not None}
+        try:
+            with open(path, 'w') as file:
+                json.dump(snapshot, file)
+        except OSError as error:
+            print('Warning: could not save the mixer state:', error)
+
+    def load(self, path):
+        "set the values saved in path as changes, returns False if there is no snapshot"
+        try:
+            with open(path) as file:
+                snapshot = json.load(file)
+        except (OSError, ValueError):
+            return False
+        for (address, value) in snapshot.items():
+            slot = self.slots.get(address)
+            if slot is not None:
+                self.set(slot, value)
+        return True
@@ -0,0 +1,516 @@
+"This module records the mixer's USB audio channels to WAV files"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# A capture thread reads interleaved frames from a source into a preallocated
+# ring buffer and a writer thread empties it to disk in large aligned chunks,
+# so a slow SD card shows up as buffer fill and overruns rather than as
+# glitches in the capture. The mixer is read in this process with pyalsaaudio,
+# or through arecord when it is not installed. Try it without a mixer:
+#   python -m lib.recorder --source synthetic --seconds 10 --tracks
+
+import argparse
+import math
+import os
+import struct
+import subprocess
+import threading
+import time
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+_ALIGN = 4096            # disk block size the writes and the audio data are aligned to
+_DS64 = struct.Struct('<QQQI')   # RF64 sizes: RIFF, data, frames and an empty table
+
+def pace(source):
+    "bytes of whole frames a source playing in real time is due to deliver, waiting for one"
+    frame = source.channels * source.sample_bytes
+    while True:
+        due = int((time.monotonic() - source.started) * source.rate) * frame - source.delivered
+        if due >= frame:
+            return due - due % frame
+        time.sleep(0.01)
+
+class AlsaSource:
+    """
+    Interleaved frames read from an ALSA capture device in this process with
+    pyalsaaudio, a period at a time. xruns counts the periods the device
+    overran because they were not read in time.
+    """
+    realtime = True
+
+    def __init__(self, device='plughw:CARD=X18XR18', channels=18, rate=48000, sample_bytes=3,
+                 period=1024):
+        self.device = device
+        self.channels = channels
+        self.rate = rate
+        self.sample_bytes = sample_bytes
+        self.period = period        # frames per read
+        self.pcm = None
+        self.pending = b''          # the part of a period that did not fit the last read
+        self.stopping = False
+        self.xruns = 0
+
+    @staticmethod
+    def available():
+        return alsaaudio is not None
+
+    def start(self):
+        formats = {2: alsaaudio.PCM_FORMAT_S16_LE, 3: alsaaudio.PCM_FORMAT_S24_3LE,
+                   4: alsaaudio.PCM_FORMAT_S32_LE}
+        try:
+            self.pcm = alsaaudio.PCM(alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL,
+                                     rate=self.rate, channels=self.channels,
+                                     format=formats[self.sample_bytes],
+                                     periodsize=self.period, device=self.device)
+        except alsaaudio.ALSAAudioError as error:
+            raise OSError(str(error))
+
+    def readinto(self, view):
+        "fill view with up to len(view) bytes, 0 once stopped"
+        data = self.pending
+        while not data:
+            if self.stopping:
+                return 0
+            (frames, data) = self.pcm.read()
+            if frames < 0:      # -EPIPE, an overrun in the driver
+                self.xruns += 1
+                data = b''
+        n = min(len(view), len(data))
+        view[:n] = data[:n]
+        self.pending = data[n:]
+        return n
+
+    def stop(self):
+        "end the stream after the period being read, safe from any thread"
+        self.stopping = True
+
+    def close(self):
+        "runs on the capture thread once it has stopped reading"
+        if self.pcm is not None:
+            self.pcm.close()
+            self.pcm = None
+
+class ArecordSource:
+    "Interleaved frames from an ALSA capture device read through arecord, without pyalsaaudio"
+    realtime = True
+    xruns = 0       # arecord reports its own
+
+    def __init__(self, device='plughw:CARD=X18XR18', channels=18, rate=48000, sample_bytes=3):
+        self.device = device
+        self.channels = channels
+        self.rate = rate
+        self.sample_bytes = sample_bytes
+        self.proc = None
+        self.partial = b''          # the start of a frame split by the last read of the pipe
+
+    def start(self):
+        formats = {2: 'S16_LE', 3: 'S24_3LE', 4: 'S32_LE'}
+        self.proc = subprocess.Popen(['arecord', '-q', '-D', self.device, '-c', str(self.channels),
+                                      '-r', str(self.rate), '-f', formats[self.sample_bytes],
+                                      '-t', 'raw'], stdout=subprocess.PIPE, bufsize=0)
+
+    def readinto(self, view):
+        """
+        whole frames only, a pipe read ends at any byte so the rest of a split
+        frame is kept for the next call
+        """
+        frame = self.channels * self.sample_bytes
+        n = len(self.partial)
+        view[:n] = self.partial
+        while True:
+            got = self.proc.stdout.readinto(view[n:]) or 0
+            n += got
+            if got == 0 or n >= frame:
+                break
+        whole = n - n % frame
+        self.partial = bytes(view[whole:n])
+        return whole
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()   # the read in progress sees the end of the stream
+
+    def close(self):
+        self.proc.wait()
+        self.proc.stdout.close()
+
+class SyntheticSource:
+    """
+    A different sine tone on each channel, paced in real time unless realtime
+    is False when it runs as fast as the recorder takes it, to test the disk.
+    """
+    xruns = 0
+
+    def __init__(self, channels=18, rate=48000, sample_bytes=3, realtime=True):
+        self.channels = channels
+        self.rate = rate
+        self.sample_bytes = sample_bytes
+        self.realtime = realtime
+        frame = channels * sample_bytes
+        peak = (1 << (8 * sample_bytes - 1)) - 1
+        frames = rate // 10             # a cycle of 0.1 s repeats exactly
+        block = bytearray(frames * frame)
+        for channel in range(channels):
+            freq = 100 * (channel + 1)
+            for i in range(frames):
+                value = int(peak * 0.5 * math.sin(2 * math.pi * freq * i / rate))
+                offset = i * frame + channel * sample_bytes
+                block[offset:offset + sample_bytes] = value.to_bytes(sample_bytes, 'little',
+                                                                     signed=True)
+        self.block = bytes(block)
+        self.pos = 0
+        self.started = None
+        self.delivered = 0
+        self.stopping = False
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def readinto(self, view):
+        if self.stopping:
+            return 0
+        size = len(view)
+        if self.realtime:
+            size = min(size, pace(self))
+        done = 0
+        while done < size:
+            n = min(size - done, len(self.block) - self.pos)
+            view[done:done + n] = self.block[self.pos:self.pos + n]
+            self.pos = (self.pos + n) % len(self.block)
+            done += n
+        self.delivered += done
+        return done
+
+    def stop(self):
+        self.stopping = True
+
+    def close(self):
+        pass
+
+class FileSource:
+    """
+    Interleaved frames from a raw file in the format given or a WAV file in
+    its own, paced in real time unless realtime is False.
+    """
+    xruns = 0
+
+    def __init__(self, path, channels=18, rate=48000, sample_bytes=3, realtime=True):
+        self.path = path
+        self.channels = channels
+        self.rate = rate
+        self.sample_bytes = sample_bytes
+        self.realtime = realtime
+        self.offset = 0             # where the audio starts
+        self.file = None
+        self.stopping = False
+        with open(path, 'rb') as file:
+            header = file.read(12)
+            if header[:4] in (b'RIFF', b'RF64') and header[8:12] == b'WAVE':
+                while True:   # skip to the data chunk, taking the format on the way
+                    (chunk, size) = struct.unpack('<4sI', file.read(8))
+                    if chunk == b'data':
+                        break
+                    body = file.read(size + (size & 1))
+                    if chunk == b'fmt ':
+                        (_, self.channels, self.rate, _, _, bits) = struct.unpack_from(
+                            '<HHIIHH', body)
+                        self.sample_bytes = bits // 8
+                self.offset = file.tell()
+
+    def start(self):
+        self.file = open(self.path, 'rb')
+        self.file.seek(self.offset)
+        self.started = time.monotonic()
+        self.delivered = 0
+
+    def readinto(self, view):
+        if self.stopping:
+            return 0
+        if self.realtime:
+            view = view[:pace(self)]
+        n = self.file.readinto(view) or 0
+        self.delivered += n
+        return n
+
+    def stop(self):
+        self.stopping = True
+
+    def close(self):
+        self.file.close()
+
+def wav_header(channels, rate, sample_bytes, data_size=0):
+    """
+    WAVE_FORMAT_EXTENSIBLE header padded with a JUNK chunk so the audio data
+    starts on a disk block boundary. Past the 4 GiB a RIFF size can hold, an
+    hour of the 18 channels takes 9.3 GB, it is an RF64 header with the
+    sizes in the ds64 chunk that the first JUNK chunk keeps room for.
+    """
+    bits = 8 * sample_bytes
+    mask = (1 << channels) - 1 if channels <= 18 else 0
+    fmt = struct.pack('<HHIIHHHHI16s', 0xFFFE, channels, rate, rate * channels * sample_bytes,
+                      channels * sample_bytes, bits, 22, bits, mask,
+                      b'\x01\x00\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71')
+    junk = _ALIGN - 12 - (8 + _DS64.size) - (8 + len(fmt)) - 8 - 8
+    riff_size = _ALIGN - 8 + data_size
+    if riff_size <= 0xFFFFFFFF:
+        start = (struct.pack('<4sI4s', b'RIFF', riff_size, b'WAVE') +
+                 struct.pack('<4sI', b'JUNK', _DS64.size) + bytes(_DS64.size))
+    else:
+        start = (struct.pack('<4sI4s', b'RF64', 0xFFFFFFFF, b'WAVE') +
+                 struct.pack('<4sI', b'ds64', _DS64.size) +
+                 _DS64.pack(riff_size, data_size, data_size // (channels * sample_bytes), 0))
+        data_size = 0xFFFFFFFF
+    return (start + struct.pack('<4sI', b'fmt ', len(fmt)) + fmt +
+            struct.pack('<4sI', b'JUNK', junk) + bytes(junk) +
+            struct.pack('<4sI', b'data', data_size))
+
+class WavWriter:
+    "A WAV file written in whole blocks with the space ahead of it preallocated"
+    def __init__(self, path, channels, rate, sample_bytes, preallocate):
+        self.path = path
+        self.channels = channels
+        self.rate = rate
+        self.sample_bytes = sample_bytes
+        self.preallocate = preallocate   # bytes reserved at a time
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.write(self.fd, wav_header(channels, rate, sample_bytes))
+        self.size = 0                    # bytes of audio written
+        self.allocated = _ALIGN
+        self.fallocate = hasattr(os, 'posix_fallocate')
+
+    def write(self, data):
+        end = _ALIGN + self.size + len(data)
+        if self.fallocate and end > self.allocated:
+            try:
+                os.posix_fallocate(self.fd, self.allocated, self.preallocate)
+                self.allocated += self.preallocate
+            except OSError:
+                self.fallocate = False   # not supported by this file system
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.size += len(data)
+
+    def close(self):
+        "drop the unused preallocated space and fill in the sizes"
+        os.ftruncate(self.fd, _ALIGN + self.size)
+        os.pwrite(self.fd, wav_header(self.channels, self.rate, self.sample_bytes,
+                                      self.size), 0)
+        os.close(self.fd)
+
+class Recorder:
+    """
+    Records a source to one polyphonic WAV file or with tracks one mono file
+    per channel, named from prefix.
+
+    The ring buffer holds buffer_seconds of audio. The capture thread only
+    copies into it and the writer thread takes chunk_frames at a time, a
+    multiple of the disk block size for both file layouts. A real time source
+    cannot wait, what does not fit is dropped and counted as an overrun, any
+    other source waits for the writer.
+
+    Every view a source reads into is a whole number of frames and a source
+    returns whole frames, so the ring and anything dropped stay on frame
+    boundaries and an overrun cannot move the channels.
+    """
+    def __init__(self, source, prefix, tracks=False, buffer_seconds=4, chunk_frames=24576,
+                 preallocate_seconds=60):
+        self.source = source
+        self.prefix = prefix
+        self.tracks = tracks
+        self.frame = source.channels * source.sample_bytes
+        self.chunk = chunk_frames * self.frame
+        chunks = max(2, math.ceil(buffer_seconds * source.rate / chunk_frames))
+        self.ring = bytearray(chunks * self.chunk)
+        self.capacity = len(self.ring)
+        self.preallocate = preallocate_seconds * source.rate * source.sample_bytes
+        if not tracks:
+            self.preallocate *= source.channels
+        self.head = 0           # bytes captured into the ring, ever
+        self.tail = 0           # bytes written out of it
+        self.ready = threading.Condition()
+        self.running = False    # asked to capture
+        self.capturing = False  # the capture thread is still adding to the ring
+        self.writers = []
+        self.threads = []
+        # live counters
+        self.overruns = 0
+        self.dropped = 0        # bytes
+        self.peak_fill = 0
+        self.written = 0        # bytes written to disk
+        self.write_time = 0.0   # seconds spent in write calls
+        self.started = None
+
+    def start(self):
+        source = self.source
+        source.start()      # first, so a missing device leaves no empty files
+        if self.tracks:
+            paths = ['%s-%02d.wav' % (self.prefix, channel + 1)
+                     for channel in range(source.channels)]
+        else:
+            paths = [self.prefix + '.wav']
+        channels = 1 if self.tracks else source.channels
+        try:
+            for path in paths:
+                self.writers.append(WavWriter(path, channels, source.rate, source.sample_bytes,
+                                              self.preallocate))
+        except OSError:
+            for writer in self.writers:
+                writer.close()
+            source.stop()
+            source.close()
+            raise
+        self.running = self.capturing = True
+        self.started = time.monotonic()
+        self.threads = [threading.Thread(target=self.capture, daemon=True),
+                        threading.Thread(target=self.write, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        "stop capturing, write out what is buffered and close the files"
+        self.running = False
+        self.source.stop()
+        with self.ready:
+            self.ready.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def capture(self):
+        "capture thread, copy the source into the ring buffer"
+        ring = memoryview(self.ring)
+        scratch = memoryview(bytearray(self.chunk))
+        realtime = self.source.realtime
+        while self.running:
+            free = self.capacity - (self.head - self.tail)
+            if free == 0 and not realtime:     # nothing is lost by waiting for the writer
+                with self.ready:
+                    while self.running and self.head - self.tail == self.capacity:
+                        self.ready.wait()
+                continue
+            if free == 0:     # the writer is behind, keep reading to not stall the source
+                n = self.source.readinto(scratch)
+                if n:
+                    self.overruns += 1
+                    self.dropped += n
+                else:
+                    break
+                continue
+            start = self.head % self.capacity
+            # capacity is whole chunks and head whole frames, so this is whole frames
+            n = self.source.readinto(ring[start:start + min(free, self.capacity - start)])
+            if n == 0:
+                break     # end of the stream
+            with self.ready:
+                self.head += n
+                fill = self.head - self.tail
+                if fill > self.peak_fill:
+                    self.peak_fill = fill
+                if fill >= self.chunk:
+                    self.ready.notify_all()
+        self.source.close()
+        with self.ready:
+            self.capturing = False
+            self.ready.notify_all()
+
+    def write(self):
+        "writer thread, empty the ring buffer to disk a chunk at a time"
+        ring = memoryview(self.ring)
+        try:
+            while True:
+                with self.ready:
+                    while self.capturing and self.head - self.tail < self.chunk:
+                        self.ready.wait()
+                    available = self.head - self.tail
+                if available >= self.chunk:
+                    size = self.chunk
+                elif not self.capturing:
+                    size = available - available % self.frame   # the last part chunk
+                    if size == 0:
+                        break
+                else:
+                    continue
+                start = self.tail % self.capacity
+                began = time.perf_counter()
+                self.store(ring[start:start + size])
+                self.write_time += time.perf_counter() - began
+                with self.ready:
+                    self.tail += size
+                    self.ready.notify_all()   # a source that is not real time may be waiting
+        finally:
+            for writer in self.writers:
+                writer.close()
+
+    def store(self, data):
+        "write interleaved frames to the file or split them into the track files"
+        if not self.tracks:
+            self.writers[0].write(data)
+            self.written += len(data)
+            return
+        width = self.source.sample_bytes
+        frame = self.frame
+        track = bytearray(len(data) // self.source.channels)
+        for (channel, writer) in enumerate(self.writers):
+            for byte in range(width):   # one strided copy per byte of the sample
+                track[byte::width] = data[channel * width + byte::frame]
+            writer.write(track)
+        self.written += len(data)
+
+    def status(self):
+        """
+        (seconds recorded, buffer fill fraction, peak fill fraction, MB/s written,
+        overruns of the ring buffer and the device)
+        """
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return (self.written / (self.frame * self.source.rate),
+                (self.head - self.tail) / self.capacity, self.peak_fill / self.capacity,
+                self.written / max(elapsed, 1e-9) / 1e6, self.overruns + self.source.xruns)
+
+    def status_text(self):
+        (seconds, fill, peak, rate, overruns) = self.status()
+        return '%d:%02d buf %d%% %.1fMB/s xrun %d' % (seconds // 60, seconds % 60, fill * 100,
+                                                      rate, overruns)
+
+def make_source(name, channels=18, realtime=True):
+    "alsa, synthetic or the path of a raw or WAV file"
+    if name == 'alsa':
+        if AlsaSource.available():
+            return AlsaSource(channels=channels)
+        print('pyalsaaudio is not installed, recording through arecord')
+        return ArecordSource(channels=channels)
+    if name == 'synthetic':
+        return SyntheticSource(channels=channels, realtime=realtime)
+    return FileSource(name, channels=channels, realtime=realtime)
+
+def main():
+    parser = argparse.ArgumentParser(description='Record the mixer USB audio channels')
+    parser.add_argument('--source', default='alsa',
+                        help='alsa, synthetic or a raw or WAV file to play in')
+    parser.add_argument('--channels', type=int, default=18)
+    parser.add_argument('--prefix', default='recording', help='output file name without .wav')
+    parser.add_argument('--tracks', action='store_true', help='one mono file per channel')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--flat-out', action='store_true',
+                        help='take a synthetic or file source as fast as the disk allows')
+    args = parser.parse_args()
+    recorder = Recorder(make_source(args.source, args.channels, not args.flat_out),
+                        args.prefix, tracks=args.tracks)
+    recorder.start()
+    try:
+        end = time.monotonic() + args.seconds
+        while recorder.capturing and time.monotonic() < end:
+            time.sleep(1)
+            print(recorder.status_text())
+    except KeyboardInterrupt:
+        pass
+    recorder.stop()
+    (seconds, fill, peak, rate, overruns) = recorder.status()
+    print('Recorded %.1f s, peak buffer %d%%, %.1f MB/s, %d overruns, %.2f s writing' % (
+        seconds, peak * 100, rate, overruns, recorder.write_time))
+
+if __name__ == '__main__':
+    main()
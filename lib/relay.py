@@ -0,0 +1,207 @@
+"This module shares one mixer connection between many displays"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import argparse
+import asyncio
+import time
+from pythonosc.osc_message import OscMessage, ParseError
+from lib.xair import XAirClient, find_mixer
+from lib.subscriptions import Subscription
+from lib.stats import stats
+
+class XAirRelay(asyncio.DatagramProtocol):
+    """
+    Holds the only connection to the mixer and looks like a mixer to the displays.
+
+    Every datagram from the mixer is kept by OSC address, so a display's /xinfo
+    and initial state queries are answered from the cache. Meter frames go to
+    the displays subscribed to the bank and parameter changes to the displays
+    with a live /xremote, both forwarded as received. A /formatsubscribe is
+    answered with the cached blob of its alias and kept alive upstream once
+    for every display, whose /renew only reaches the relay, and each blob goes
+    to the displays subscribed to its alias. Sets are passed on to the mixer,
+    which echoes them back to be fanned out. The mixer only sees one client
+    whatever the number of displays.
+    """
+    _SUBSCRIPTION_TIME = 10  # seconds a /xremote, /meters or /formatsubscribe lasts
+    _EXPIRE_INTERVAL = 1
+
+    def __init__(self, mixer, mixer_port=XAirClient.XAIR_PORT,
+                 host='0.0.0.0', port=XAirClient.XAIR_PORT):
+        self.cache = {}     # OSC address -> latest datagram from the mixer
+        self.remote = {}    # display address -> /xremote expiry
+        self.meters = {}    # meter bank -> {display address: expiry}
+        self.formats = {}   # format subscription alias -> {display address: expiry}
+        self.pending = {}   # OSC address -> displays waiting for a reply
+        self.transport = None
+        self.failed = False
+        self.client = XAirClient(mixer, self, mixer_port)
+        self.client.meter_banks = []   # only the banks some display asks for
+        self.client.server.taps.append(self.from_mixer)
+        # format subscription blobs a display asked for, forwarded raw by from_mixer
+        self.client.server.dispatcher.map('/xrem/*', self.client.null_handler)
+        asyncio.run_coroutine_threadsafe(self.open(host, port), self.client.loop).result()
+        print('Relaying on %s:%d' % (host, port))
+        self.client.start_connection()
+
+    async def open(self, host, port):
+        "Bind the UDP socket the displays talk to."
+        await self.client.loop.create_datagram_endpoint(lambda: self,
+                                                        local_addr=(host, port))
+        self.client.spawn(self.expire())
+
+    def stop(self):
+        "Close both sides, safe from any thread."
+        if self.transport is not None and not self.client.closing:
+            self.client.loop.call_soon_threadsafe(self.transport.close)
+        self.client.stop_server()
+
+# the state object of the XAirClient, messages are taken raw by from_mixer instead
+    def osc_routes(self):
+        return []
+
+    def received_meters(self, addr, *data):
+        pass
+
+    def connected(self, info):
+        pass
+
+    def sync_progress(self, done, total):
+        pass
+
+    def sync_done(self, failed):
+        print('Cached %d parameters' % len(self.cache))
+
+    def connect_failed(self):
+        self.failed = True
+
+# mixer side, runs on the XAirClient event loop
+    def from_mixer(self, data):
+        "Forward a datagram from the mixer to the displays that want it."
+        if data.startswith(b'/meters/'):
+            bank = int(data[8:data.index(b'\0')])
+            displays = self.meters.get(bank)
+            if displays:
+                for display in displays:
+                    self.transport.sendto(data, display)
+                if stats.enabled:
+                    stats.count('relay meters out', len(displays))
+            return
+        address = data[:data.find(b'\0')].decode()
+        displays = self.formats.get(address)
+        if displays is not None:   # a format subscription blob, every one to its subscribers
+            self.cache[address] = data
+            for display in displays:
+                self.transport.sendto(data, display)
+            return
+        previous = self.cache.get(address)
+        self.cache[address] = data
+        waiting = self.pending.pop(address, ())
+        for display in waiting:
+            if display not in self.remote:
+                self.transport.sendto(data, display)
+        if data != previous:   # replies to the relay's own queries change nothing
+            self.broadcast(data)
+
+    def broadcast(self, data):
+        "send data to every display with a live /xremote"
+        for display in self.remote:
+            self.transport.sendto(data, display)
+        if stats.enabled:
+            stats.count('relay params out', len(self.remote))
+
+    async def expire(self):
+        "Drop lapsed display subscriptions and the meter banks nobody wants any more."
+        while True:
+            await asyncio.sleep(self._EXPIRE_INTERVAL)
+            now = time.monotonic()
+            for (display, expiry) in list(self.remote.items()):
+                if expiry < now:
+                    del self.remote[display]
+            for (bank, displays) in self.meters.items():
+                for (display, expiry) in list(displays.items()):
+                    if expiry < now:
+                        del displays[display]
+                if not displays and bank in self.client.meter_banks:
+                    self.client.subscribe_meters(bank, False)
+            for (alias, displays) in self.formats.items():
+                for (display, expiry) in list(displays.items()):
+                    if expiry < now:
+                        del displays[display]
+                if not displays:
+                    self.client.subscriptions.remove(alias)
+
+# display side
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, display):
+        "Answer a display from the cache or pass its message on to the mixer."
+        try:
+            message = OscMessage(data)
+        except ParseError:
+            return
+        address = message.address
+        params = message.params
+        if address in ('/xremote', '/xremotenfb'):
+            self.remote[display] = time.monotonic() + self._SUBSCRIPTION_TIME
+        elif address == '/meters' and params:
+            bank = int(str(params[0]).split('/')[-1])
+            self.meters.setdefault(bank, {})[display] = (time.monotonic() +
+                                                         self._SUBSCRIPTION_TIME)
+            self.client.subscribe_meters(bank)
+        elif address == '/formatsubscribe' and params:
+            self.subscribe_format(display, params)
+        elif address == '/renew' and params:
+            displays = self.formats.get(params[0])
+            if displays is not None and display in displays:
+                displays[display] = time.monotonic() + self._SUBSCRIPTION_TIME
+        elif params:     # a set
+            self.to_mixer(data)
+        elif address in self.cache:
+            self.transport.sendto(self.cache[address], display)
+        else:   # not seen yet, the reply goes to every display waiting for it
+            self.pending.setdefault(address, set()).add(display)
+            self.to_mixer(data)
+
+    def subscribe_format(self, display, params):
+        """
+        Add display to the subscribers of a format alias, subscribing upstream
+        for the first, and send it the latest blob if there is one.
+        """
+        alias = params[0]
+        displays = self.formats.setdefault(alias, {})
+        displays[display] = time.monotonic() + self._SUBSCRIPTION_TIME
+        subscriptions = self.client.subscriptions
+        if alias not in subscriptions.subscriptions:
+            subscriptions.add(Subscription(alias, '/formatsubscribe', list(params),
+                                           ('/renew', [alias]), watch=alias))
+        if alias in self.cache:
+            self.transport.sendto(self.cache[alias], display)
+
+    def to_mixer(self, data):
+        self.client.server.transport.sendto(data, self.client.server.xr_address)
+
+def main():
+    parser = argparse.ArgumentParser(description='Share one XAir mixer between many displays')
+    parser.add_argument('--mixer', metavar='HOST',
+                        help='mixer address, searched for if not given')
+    parser.add_argument('--mixer-port', type=int, default=XAirClient.XAIR_PORT)
+    parser.add_argument('--host', default='0.0.0.0', help='address the displays connect to')
+    parser.add_argument('--port', type=int, default=XAirClient.XAIR_PORT)
+    args = parser.parse_args()
+    mixer = args.mixer or find_mixer()
+    if mixer is None:
+        return
+    relay = XAirRelay(mixer, args.mixer_port, args.host, args.port)
+    try:
+        while not relay.failed:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    relay.stop()
+
+if __name__ == '__main__':
+    main()
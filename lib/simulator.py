@@ -0,0 +1,188 @@
+"This module impersonates an XAir mixer on UDP for testing and benchmarks"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import argparse
+import asyncio
+import math
+import struct
+import time
+from pythonosc.osc_message import OscMessage, ParseError
+from pythonosc.osc_message_builder import OscMessageBuilder
+from lib.mixer import display_params
+
+_SUBSCRIPTION_TIME = 10    # seconds a /xremote or /meters request lasts
+_FRAMES = 64               # distinct meter frames cycled through per bank
+
+def build_message(address, *args):
+    "OSC datagram for address with args"
+    builder = OscMessageBuilder(address=address)
+    for arg in args:
+        builder.add_arg(arg)
+    return builder.build().dgram
+
+def meter_frames(count, frames=_FRAMES):
+    "meter blobs with count values moving smoothly between -60 dB and 0 dB"
+    blobs = []
+    for frame in range(frames):
+        values = []
+        for i in range(count):
+            level = (math.sin(2 * math.pi * (frame / frames + i / count)) - 1) * 30
+            values.append(int(level * 256))
+        blobs.append(struct.pack('<L%dh' % count, count, *values))
+    return blobs
+
+def default_state():
+    "plausible values for every parameter the display asks for"
+    state = {}
+    for address in display_params():
+        if address.endswith('/name'):
+            state[address] = address.split('/')[2].upper()
+        elif address.endswith('/color'):
+            state[address] = 2
+        elif address.endswith('/ratio'):
+            state[address] = 5
+        else:
+            state[address] = 0.5
+    return state
+
+class MixerSimulator(asyncio.DatagramProtocol):
+    """
+    Answers /xinfo and parameter queries, broadcasts parameter changes to the
+    /xremote clients and streams the subscribed /meters banks and format
+    subscriptions.
+    """
+    def __init__(self, rate=20, sizes=None, name='XR18-SIM', formats=True):
+        self.rate = rate
+        self.formats_supported = formats
+        self.sizes = sizes or {2: 18, 4: 100, 5: 40}
+        self.name = name
+        self.state = default_state()
+        self.frames = {bank: meter_frames(size) for (bank, size) in self.sizes.items()}
+        self.remote = {}   # client address -> /xremote expiry
+        self.meters = {}   # (client address, bank) -> expiry
+        self.formats = {}  # (client address, alias) -> [expiry, addresses, period, next send]
+        self.transport = None
+        self.sent = 0      # meter datagrams sent
+        self.task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.task = asyncio.get_running_loop().create_task(self.stream())
+
+    def connection_lost(self, exc):
+        if self.task is not None:
+            self.task.cancel()
+
+    def datagram_received(self, data, client):
+        try:
+            message = OscMessage(data)
+        except ParseError:
+            return
+        address = message.address
+        params = message.params
+        if address == '/xinfo':
+            host = self.transport.get_extra_info('sockname')[0]
+            self.transport.sendto(build_message('/xinfo', host, self.name, 'XR18', '1.17'),
+                                  client)
+        elif address in ('/xremote', '/xremotenfb'):
+            self.remote[client] = time.monotonic() + _SUBSCRIPTION_TIME
+        elif address == '/meters' and params:
+            bank = int(params[0].split('/')[-1])
+            if bank in self.frames:
+                self.meters[(client, bank)] = time.monotonic() + _SUBSCRIPTION_TIME
+        elif address == '/formatsubscribe' and len(params) >= 5 and self.formats_supported:
+            (alias, pattern, first, last, factor) = params[:5]
+            width = 2 if pattern.startswith('/ch') or pattern.startswith('/headamp') else 1
+            addresses = [pattern.replace('**', '{:0>{}d}'.format(i, width))
+                         for i in range(first, last + 1)]
+            now = time.monotonic()
+            self.formats[(client, alias)] = [now + _SUBSCRIPTION_TIME, addresses,
+                                             max(factor, 1) * 0.05, now]
+        elif address == '/renew' and params:
+            subscription = self.formats.get((client, params[0]))
+            if subscription is not None:
+                subscription[0] = time.monotonic() + _SUBSCRIPTION_TIME
+        elif address in self.state:
+            if params:     # a set, echo it to every remote client
+                self.state[address] = params[0]
+                self.broadcast(build_message(address, params[0]))
+            else:
+                self.transport.sendto(build_message(address, self.state[address]), client)
+
+    def broadcast(self, data):
+        "send data to every client with a live /xremote"
+        now = time.monotonic()
+        for (client, expiry) in list(self.remote.items()):
+            if expiry < now:
+                del self.remote[client]
+            else:
+                self.transport.sendto(data, client)
+
+    def send_formats(self, now):
+        "send the format subscriptions that are due as blobs of 4 byte values"
+        for ((client, alias), subscription) in list(self.formats.items()):
+            (expiry, addresses, period, due) = subscription
+            if expiry < now:
+                del self.formats[(client, alias)]
+            elif due <= now:
+                values = [self.state.get(a, 0) for a in addresses]
+                code = ''.join('i' if isinstance(v, int) else 'f' for v in values)
+                blob = struct.pack('<' + code, *values)
+                self.transport.sendto(build_message(alias, blob), client)
+                subscription[3] = now + period
+
+    async def stream(self):
+        "send the subscribed meter banks at the meter rate"
+        loop = asyncio.get_running_loop()
+        frame = 0
+        period = 1 / self.rate
+        next_time = loop.time()
+        while True:
+            now = time.monotonic()
+            for ((client, bank), expiry) in list(self.meters.items()):
+                if expiry < now:
+                    del self.meters[(client, bank)]
+                    continue
+                blob = self.frames[bank][frame % _FRAMES]
+                self.transport.sendto(build_message('/meters/%d' % bank, blob), client)
+                self.sent += 1
+            self.send_formats(now)
+            frame += 1
+            next_time += period
+            await asyncio.sleep(max(0, next_time - loop.time()))
+
+async def serve(host='0.0.0.0', port=10024, **kwargs):
+    "run a simulator on host:port, returns (transport, simulator)"
+    loop = asyncio.get_running_loop()
+    return await loop.create_datagram_endpoint(lambda: MixerSimulator(**kwargs),
+                                               local_addr=(host, port))
+
+def main():
+    parser = argparse.ArgumentParser(description='Impersonate an XAir mixer')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=10024)
+    parser.add_argument('--rate', type=float, default=20,
+                        help='meter packets per second per bank')
+    parser.add_argument('--bank', action='append', metavar='N:COUNT',
+                        help='meter bank and number of values, default 2:18, 4:100 and 5:40')
+    parser.add_argument('--no-formatsubscribe', action='store_true',
+                        help='ignore /formatsubscribe like an older firmware')
+    args = parser.parse_args()
+    sizes = None
+    if args.bank:
+        sizes = {int(n): int(c) for (n, c) in (b.split(':') for b in args.bank)}
+
+    async def run():
+        await serve(args.host, args.port, rate=args.rate, sizes=sizes,
+                    formats=not args.no_formatsubscribe)
+        print('Simulating a mixer on %s:%d' % (args.host, args.port))
+        await asyncio.Event().wait()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
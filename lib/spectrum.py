@@ -0,0 +1,95 @@
+"This module draws the mixer RTA meter bank as a spectrum from a single Mesh"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+import math
+from array import array
+from kivy.uix.widget import Widget
+from kivy.graphics import Color, Mesh
+from kivy.clock import Clock
+from lib.meters import decode_meters
+
+def log_bins(bands, columns, low=20.0, high=20000.0):
+    """
+    Map log spaced RTA bands from low to high Hz onto display columns that are
+    also log spaced, returns a (first band, last band + 1) range per column.
+    """
+    span = math.log(high / low)
+    bins = []
+    for column in range(columns):
+        f0 = low * math.exp(span * column / columns)
+        f1 = low * math.exp(span * (column + 1) / columns)
+        first = int(round(math.log(f0 / low) / span * (bands - 1)))
+        last = int(round(math.log(f1 / low) / span * (bands - 1)))
+        bins.append((min(first, bands - 1), max(first + 1, min(last, bands))))
+    return bins
+
+class SpectrumView(Widget):
+    """
+    Spectrum of the /meters/4 RTA bank, one quad per column in one Mesh whose
+    vertices are updated in place when a new packet has arrived.
+    """
+    def __init__(self, columns=50, floor=-90.0, **kwargs):
+        super().__init__(**kwargs)
+        self.columns = columns
+        self.floor = floor
+        self.bins = None          # computed for the band count of the packets
+        self.bands = 0
+        self.values = None        # latest decoded RTA packet, set by the OSC thread
+        self.dirty = False
+        self.heights = [0.0] * columns
+        self.vertices = array('f', bytes(4 * columns * 16))   # shared with the Mesh
+        indices = []
+        for c in range(columns):
+            v = c * 4
+            indices.extend((v, v + 1, v + 2, v, v + 2, v + 3))
+        with self.canvas:
+            Color(0, .8, 0, 1)
+            self.mesh = Mesh(vertices=self.vertices, indices=indices, mode='triangles')
+        self.bind(pos=self.layout, size=self.layout)
+        Clock.schedule_interval(self.redraw, 0) # once per frame
+
+    def store(self, blob):
+        "receive an RTA packet on the OSC thread, decoded in one call"
+        self.values = decode_meters(blob)
+        self.dirty = True
+
+    def layout(self, *args):
+        "place the columns across the widget"
+        width = self.width / self.columns
+        verts = self.vertices
+        for c in range(self.columns):
+            x0 = self.x + c * width + 1
+            x1 = self.x + (c + 1) * width - 1
+            base = c * 16
+            for (i, value) in enumerate((x0, self.y, 0, 0, x1, self.y, 1, 0,
+                                         x1, self.y, 1, 1, x0, self.y, 0, 1)):
+                verts[base + i] = value
+        self.set_heights()
+
+    def redraw(self, dt):
+        "recompute the column heights if a new packet arrived, runs on the UI thread"
+        if not self.dirty or self.opacity == 0:
+            return
+        self.dirty = False
+        values = self.values
+        if len(values) != self.bands:
+            self.bands = len(values)
+            self.bins = log_bins(self.bands, self.columns)
+        scale = 1 / (-self.floor * 256)
+        offset = -self.floor * 256
+        heights = self.heights
+        for (c, (first, last)) in enumerate(self.bins):
+            level = (max(values[first:last]) + offset) * scale
+            heights[c] = 0.0 if level < 0 else (1.0 if level > 1 else level)
+        self.set_heights()
+
+    def set_heights(self):
+        "move the top vertices of every column in place and flag them for upload"
+        verts = self.vertices
+        for (c, height) in enumerate(self.heights):
+            top = self.y + self.height * height
+            verts[c * 16 + 9] = top
+            verts[c * 16 + 13] = top
+        self.mesh.vertices = verts
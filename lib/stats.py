@@ -0,0 +1,108 @@
+"This module keeps low overhead counters and histograms for the hot paths"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# Callers test stats.enabled before measuring anything, so when disabled the
+# cost is one attribute lookup per hot path.
+
+import time
+from array import array
+
+class Histogram:
+    "Counts of values in power of two buckets"
+    BUCKETS = 40
+
+    def __init__(self, unit=1e-6):
+        self.unit = unit       # value of the smallest bucket, 1 us for times
+        self.counts = array('L', [0] * self.BUCKETS)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        bucket = int(value / self.unit).bit_length()
+        self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        self.total += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        "upper bound of the bucket holding the given fraction of the values"
+        target = fraction * self.total
+        seen = 0
+        for (bucket, count) in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min((1 << bucket) * self.unit, self.max)
+        return 0.0
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0.0
+
+class Stats:
+    "Named counters and histograms, toggled as a whole"
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.monotonic()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, name, value, unit=1e-6):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(unit)
+        histogram.add(value)
+
+    def report(self):
+        "lines of text describing everything measured so far"
+        elapsed = time.monotonic() - self.started
+        lines = ['%.1f s measured' % elapsed]
+        for (name, count) in sorted(self.counters.items()):
+            lines.append('%-24s %9d %9.1f/s' % (name, count, count / max(elapsed, 1e-9)))
+        for (name, histogram) in sorted(self.histograms.items()):
+            if histogram.unit < 1:
+                scale, unit = 1000, 'ms'
+            else:
+                scale, unit = 1, ''
+            lines.append('%-24s n %d mean %.2f p50 %.2f p99 %.2f max %.2f %s' % (
+                name, histogram.total, histogram.mean() * scale,
+                histogram.percentile(.5) * scale, histogram.percentile(.99) * scale,
+                histogram.max * scale, unit))
+        return lines
+
+    def dump(self, path):
+        "write the report to path"
+        with open(path, 'w') as file:
+            file.write('\n'.join(self.report()) + '\n')
+
+class PhaseTimer:
+    "Time taken by each named phase of a sequence such as start up"
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.last = self.start
+        self.phases = []   # (name, seconds)
+
+    def mark(self, name):
+        "end the current phase, naming it"
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self):
+        "lines of text with the time of each phase and the total"
+        lines = ['%-24s %8.1f ms' % (name, seconds * 1000) for (name, seconds) in self.phases]
+        lines.append('%-24s %8.1f ms' % ('total', (self.last - self.start) * 1000))
+        return lines
+
+# shared by the whole application
+stats = Stats()
@@ -0,0 +1,130 @@
+"This module keeps the mixer subscriptions alive and decodes format subscription blobs"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# The mixer drops a /xremote, /meters or /formatsubscribe request after 10 s.
+# A format subscription sends a group of numeric parameters as one blob of
+# little endian 4 byte values, /formatsubscribe alias pattern first last factor
+# where ** in the pattern is replaced by each index from first to last and a
+# blob is sent every factor * 50 ms, kept alive with /renew alias.
+
+import asyncio
+import struct
+import time
+
+class Subscription:
+    """
+    One request the mixer forgets after a while, sent again before it does.
+    watch is the OSC address of the stream it starts, if any, to notice when
+    that stops arriving.
+    """
+    def __init__(self, name, address, args=None, renew=None, watch=None):
+        self.name = name
+        self.request = (address, args)
+        self.renew = renew or self.request   # (address, args) keeping it alive
+        self.watch = watch
+        self.due = 0.0                       # loop time of the next send, 0 for now
+
+class SubscriptionManager:
+    """
+    Sends each subscription when added and renews it every (lifetime - margin)
+    / 2 seconds, sleeping until the next one is due rather than on a fixed
+    period. Two renewals fit in the lifetime, so a lost one is made up by the
+    next before the mixer drops it. A subscription whose watched address has
+    not been heard from for a period has lapsed anyway and is sent in full,
+    a /formatsubscribe rather than a /renew. Runs on the event loop of the
+    XAirClient.
+    """
+    def __init__(self, send, lifetime=10, margin=1, heard=None):
+        self.send = send          # send(address, args)
+        self.period = (lifetime - margin) / 2
+        self.heard = {} if heard is None else heard   # watched address -> time.monotonic()
+        self.subscriptions = {}   # name -> Subscription
+        self.wake = asyncio.Event()
+
+    def add(self, subscription, sent=False):
+        "Keep subscription alive, sending it first unless sent is True."
+        if sent:
+            subscription.due = asyncio.get_running_loop().time() + self.period
+        if subscription.watch is not None:
+            self.heard[subscription.watch] = time.monotonic()
+        self.subscriptions[subscription.name] = subscription
+        self.wake.set()
+
+    def remove(self, name):
+        "Stop renewing a subscription, the mixer drops it when it lapses."
+        subscription = self.subscriptions.pop(name, None)
+        if subscription is not None and subscription.watch is not None:
+            self.heard.pop(subscription.watch, None)
+
+    def lapsed(self, subscription):
+        "True if the stream of a watched subscription has stopped"
+        if subscription.watch is None:
+            return False
+        return time.monotonic() - self.heard.get(subscription.watch, 0.0) > self.period
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            for subscription in list(self.subscriptions.values()):
+                if subscription.due <= now:
+                    first = not subscription.due
+                    self.send(*(subscription.request if first or self.lapsed(subscription)
+                                else subscription.renew))
+                    subscription.due = now + self.period
+            due = min((s.due for s in self.subscriptions.values()), default=now + self.period)
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(0, due - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+class FormatGroup:
+    """
+    Parameters read through one format subscription, their blob decoded with
+    one struct call and stored in the mixer state together.
+    """
+    def __init__(self, state, alias, pattern, first, last, code, factor):
+        self.state = state
+        self.alias = alias
+        self.pattern = pattern
+        self.first = first
+        self.last = last
+        self.factor = factor
+        width = 2 if pattern.startswith('/ch') or pattern.startswith('/headamp') else 1
+        self.addresses = [pattern.replace('**', '{:0>{}d}'.format(i, width))
+                          for i in range(first, last + 1)]
+        self.slots = [state.slots[address] for address in self.addresses]
+        self.struct = struct.Struct('<%d%s' % (len(self.slots), code))
+
+    def request(self):
+        "arguments of the /formatsubscribe starting this group"
+        return [self.alias, self.pattern, self.first, self.last, self.factor]
+
+    def received(self, blob, *data):
+        "store the values of a blob, runs on the OSC thread"
+        size = self.struct.size
+        offset = 4 if len(blob) == size + 4 else 0   # skip a leading value count
+        if len(blob) < offset + size:
+            return
+        self.state.update(self.slots, self.struct.unpack_from(blob, offset))
+
+# (alias, pattern, first, last, struct code) of the numeric parameters shown,
+# names and the single Aux and Main parameters are still read by query
+FORMATS = [
+    ('/xrem/color', '/ch/**/config/color', 1, 17, 'i'),
+    ('/xrem/mgain', '/ch/**/dyn/mgain', 1, 17, 'f'),
+    ('/xrem/thr', '/ch/**/dyn/thr', 1, 17, 'f'),
+    ('/xrem/ratio', '/ch/**/dyn/ratio', 1, 17, 'i'),
+    ('/xrem/gain', '/headamp/**/gain', 1, 17, 'f'),
+    ('/xrem/busmgain', '/bus/**/dyn/mgain', 1, 6, 'f'),
+    ('/xrem/busthr', '/bus/**/dyn/thr', 1, 6, 'f'),
+    ('/xrem/busratio', '/bus/**/dyn/ratio', 1, 6, 'i'),
+]
+
+def format_groups(state, factor=40):
+    "FormatGroup for each of FORMATS storing into the mixer state, a blob every factor * 50 ms"
+    return [FormatGroup(state, alias, pattern, first, last, code, factor)
+            for (alias, pattern, first, last, code) in FORMATS]
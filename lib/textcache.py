@@ -0,0 +1,83 @@
+"This module caches rendered text textures for the frequently changing readouts"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+
+from collections import OrderedDict
+from kivy.uix.widget import Widget
+from kivy.graphics import Color, Rectangle
+from kivy.core.text import Label as CoreLabel
+from kivy.properties import StringProperty, NumericProperty
+from kivy.metrics import sp
+from kivy.clock import Clock
+
+class TextureCache:
+    """
+    Least recently used cache of rendered text.
+
+    Readouts such as "-12.3 dB", "th -20.0" or "r 4.0" come from a small
+    bounded set, so once warm a readout update is a texture swap rather than a
+    render through the text provider.
+    """
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.textures = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text, font_size):
+        "return the texture for text, rendering it if it is not cached"
+        key = (text, font_size)
+        texture = self.textures.get(key)
+        if texture is not None:
+            self.textures.move_to_end(key)
+            self.hits += 1
+            return texture
+        self.misses += 1
+        label = CoreLabel(text=text, font_size=font_size)
+        label.refresh()
+        texture = self.textures[key] = label.texture
+        if len(self.textures) > self.maxsize:
+            self.textures.popitem(last=False)
+        return texture
+
+# shared by every readout in the application
+texture_cache = TextureCache()
+
+def rotated_coords(texture):
+    "tex_coords showing texture rotated counter clockwise by 90 degrees"
+    t = texture.tex_coords
+    return (t[6], t[7], t[0], t[1], t[2], t[3], t[4], t[5])
+
+class RotatedText(Widget):
+    "A Label rotated by 90 degrees showing a texture from the texture cache"
+    text = StringProperty("")
+    font_size = NumericProperty(sp(15))
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        with self.canvas:
+            Color(1, 1, 1, 1)
+            self.rect = Rectangle(size=(0, 0))
+        # like Label, text may be set from the OSC thread so defer to the next frame
+        self.trigger_update = Clock.create_trigger(self.update, -1)
+        self.bind(text=self.trigger_update, font_size=self.trigger_update,
+                  pos=self.place, size=self.place)
+        self.update()
+
+    def update(self, *args):
+        "swap in the texture for the current text, runs on the UI thread"
+        if self.text == "":
+            self.rect.texture = None
+            self.rect.size = (0, 0)
+            return
+        texture = texture_cache.get(self.text, self.font_size)
+        self.rect.texture = texture
+        self.rect.tex_coords = rotated_coords(texture)
+        self.rect.size = (texture.height, texture.width)
+        self.place()
+
+    def place(self, *args):
+        "center the text in the widget"
+        (tw, th) = self.rect.size
+        self.rect.pos = (self.center_x - tw / 2, self.center_y - th / 2)
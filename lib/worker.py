@@ -0,0 +1,264 @@
+"This module runs the mixer connection and OSC decoding in a separate process"
+# part of XTouchPiRemote
+# Copyright (c) 2021 Ross Dickson
+# Some rights reserved. See LICENSE.
+#
+# The worker is forked when connecting so the shared memory mapping and the
+# pipe are inherited rather than attached by name. It only imports Kivy-free
+# modules and never touches the display's objects.
+
+import multiprocessing
+import struct
+from multiprocessing import shared_memory
+from lib.meters import MeterBuffer, RTA_BANK
+from lib.headless import MeterEngine
+
+_HEADER = struct.Struct('<2Q')   # meter and parameter sequence counters
+_SLOT = struct.Struct('<Bd23s')  # kind, number and text of one parameter
+_NONE, _INT, _FLOAT, _TEXT = range(4)
+_READ_TRIES = 1000               # reads of a parameter update in progress before giving up
+
+class SharedState:
+    """
+    Meter values and parameter state in one shared memory block.
+
+    The block holds a header of sequence counters, the values and dirty flags
+    of a MeterBuffer, one fixed size slot per MixerState slot and the parameter
+    sequence at which each slot was last written. Meters and parameters each
+    have a single writer in the worker that makes its counter odd while
+    writing, so a reader seeing the same even count before and after reading
+    has a consistent copy, a seqlock. The display reads the meters in place.
+    """
+    def __init__(self, strips, params):
+        meters = strips * 3
+        meter_offset = _HEADER.size
+        param_offset = (meter_offset + 3 * meters + 7) & ~7
+        written_offset = param_offset + _SLOT.size * params
+        size = written_offset + 4 * params
+        self.params = params
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        buf = self.memory.buf
+        buf[:size] = bytes(size)
+        self.header = buf[:_HEADER.size].cast('Q')
+        self.meters = MeterBuffer(strips, buf, meter_offset)
+        self.slots = buf[param_offset:written_offset]
+        self.written = buf[written_offset:size].cast('I')
+
+    def close(self):
+        "unmap and remove the block, once nothing else holds a view of the meters"
+        for view in (self.written, self.slots, self.meters.dirty, self.meters.values,
+                     self.header):
+            view.release()
+        self.memory.close()
+        self.memory.unlink()
+
+# worker side
+    def begin_meters(self):
+        self.header[0] += 1
+
+    def end_meters(self):
+        self.header[0] += 1
+
+    def write_params(self, changes):
+        "store (slot, raw value) changes"
+        header = self.header
+        header[1] += 1
+        seq = (header[1] + 1) & 0xffffffff
+        for (slot, value) in changes:
+            if isinstance(value, str):
+                fields = (_TEXT, 0.0, value.encode()[:_SLOT.size - 9])
+            elif isinstance(value, int):
+                fields = (_INT, float(value), b'')
+            else:
+                fields = (_FLOAT, float(value), b'')
+            _SLOT.pack_into(self.slots, slot * _SLOT.size, *fields)
+            self.written[slot] = seq
+        header[1] += 1
+
+# display side
+    def meter_seq(self):
+        return self.header[0]
+
+    def param_seq(self):
+        return self.header[1]
+
+    def read_params(self, seen):
+        """
+        (slot, raw value) for every slot written since seen, an array of the
+        sequence at which each slot was last read, updated in place. None if
+        the writer is still mid update after _READ_TRIES reads, so has died.
+        """
+        for _ in range(_READ_TRIES):
+            seq = self.header[1]
+            if seq & 1:
+                continue   # being written, takes microseconds
+            written = self.written
+            changed = [slot for slot in range(self.params) if written[slot] != seen[slot]]
+            values = [_SLOT.unpack_from(self.slots, slot * _SLOT.size) for slot in changed]
+            marks = [written[slot] for slot in changed]
+            if self.header[1] == seq:
+                break
+        else:
+            return None
+        changes = []
+        for (slot, mark, (kind, number, text)) in zip(changed, marks, values):
+            seen[slot] = mark
+            if kind == _TEXT:
+                changes.append((slot, text.rstrip(b'\0').decode(errors='replace')))
+            elif kind == _INT:
+                changes.append((slot, int(number)))
+            elif kind == _FLOAT:
+                changes.append((slot, number))
+        return changes
+
+class WorkerEngine(MeterEngine):
+    "MeterEngine of the worker, meters go to shared memory and events to the display"
+    def __init__(self, shared, conn):
+        super().__init__()
+        self.shared = shared
+        self.conn = conn
+        self.meter_buffer = shared.meters
+
+    def osc_routes(self):
+        yield from super().osc_routes()
+        yield ('/meters/%d' % RTA_BANK, self.rta_handler, ())
+
+    def meter_handler(self, routes, blob):
+        shared = self.shared
+        shared.begin_meters()
+        super().meter_handler(routes, blob)
+        shared.end_meters()
+
+    def rta_handler(self, blob):
+        self.conn.send(('rta_handler', blob))   # only subscribed while the panel shows
+
+    def connected(self, info):
+        self.conn.send(('connected', list(info)))
+
+    def sync_progress(self, done, total):
+        self.conn.send(('sync_progress', done, total))
+
+    def sync_done(self, failed):
+        self.conn.send(('sync_done', failed))
+
+    def connect_failed(self):
+        super().connect_failed()
+        self.conn.send(('connect_failed',))
+
+def serve(shared, conn, address, port):
+    "The worker process: run an XAirClient and carry out the display's commands"
+    from lib.xair import XAirClient, initial_queries
+    from lib.subscriptions import format_groups
+    engine = WorkerEngine(shared, conn)
+    client = XAirClient(address, engine, port)
+    client.queries = initial_queries()
+    client.formats = format_groups(engine.mixer_state)
+    try:
+        while not engine.failed:
+            if conn.poll(0.02):
+                (command, *args) = conn.recv()
+                if command == 'stop':
+                    break
+                getattr(client, command)(*args)
+            changes = list(engine.mixer_state.changes())
+            if changes:
+                shared.write_params(changes)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        client.stop_server()
+
+class WorkerClient:
+    """
+    Stands in for an XAirClient running in a worker process.
+
+    The display calls the same methods, which are sent to the worker as
+    commands, and calls poll once per frame to take the worker's events and
+    the parameters changed in shared memory. The meters are read by the
+    display from the MeterBuffer in state.shared directly.
+    """
+    XAIR_PORT = 10024
+    info_response = []
+    queries = None      # the worker reads all of the state itself
+    formats = None
+
+    def __init__(self, address, state, port=XAIR_PORT):
+        self.state = state
+        self.shared = state.shared
+        self.seen = [0] * self.shared.params
+        self.meter_seq = 0
+        self.param_seq = 0
+        self.failed = False
+        (self.conn, child) = multiprocessing.Pipe()
+        self.process = multiprocessing.get_context('fork').Process(
+            target=serve, args=(self.shared, child, address, port), daemon=True)
+        self.process.start()
+        child.close()
+
+    def command(self, *message):
+        try:
+            self.conn.send(message)
+        except OSError:
+            pass    # the worker has gone, connect_failed is on its way
+
+    def start_connection(self):
+        self.command('start_connection')
+
+    def start_capture(self, path):
+        self.command('start_capture', path)
+
+    def start_replay(self, path, speed=1.0):
+        self.command('start_replay', path, speed)
+
+    def subscribe_meters(self, bank, on=True):
+        self.command('subscribe_meters', bank, on)
+
+    def send(self, address, param=None):
+        self.command('send', address, param)
+
+    def stop_server(self):
+        "Stop the worker and wait for it to close the connection."
+        self.command('stop')
+        self.process.join(2)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+    def poll(self):
+        """
+        Hand the worker's events to the state, record a new meter frame and
+        store the changed parameters, runs on the display thread.
+        """
+        state = self.state
+        try:
+            while self.conn.poll():
+                (event, *args) = self.conn.recv()
+                if event == 'connected':
+                    self.info_response = args[0]
+                elif event == 'connect_failed':
+                    self.failed = True      # the worker exits, no need to report that
+                getattr(state, event)(*args)
+        except (EOFError, OSError):
+            self.worker_died()
+            return
+        seq = self.shared.meter_seq()
+        if seq != self.meter_seq and not seq & 1:
+            self.meter_seq = seq
+            state.history.record(self.shared.meters.values)
+        seq = self.shared.param_seq()
+        if seq != self.param_seq:
+            changes = self.shared.read_params(self.seen)
+            if changes is None:
+                if not self.process.is_alive():
+                    self.worker_died()
+                return
+            self.param_seq = seq
+            mixer_state = state.mixer_state
+            for (slot, value) in changes:
+                mixer_state.set(slot, value)
+
+    def worker_died(self):
+        "report a worker that exited without a connect_failed once"
+        if not self.failed:
+            self.failed = True
+            self.state.connect_failed()
@@ -4,20 +4,81 @@
 # Additions Copyright (c) 2021 Ross Dickson
 # Some rights reserved. See LICENSE.
 
-import time
+import asyncio
+import os
 import threading
+import time
 import socket
 import netifaces
 from pythonosc.dispatcher import Dispatcher
-from pythonosc.osc_server import BlockingOSCUDPServer
-from pythonosc.osc_message import OscMessage
+from pythonosc.osc_packet import OscPacket, ParseError
+from pythonosc.osc_message import OscMessage, ParseError as MessageParseError
 from pythonosc.osc_message_builder import OscMessageBuilder
+from lib.capture import CaptureWriter, replay_async
+from lib.subscriptions import Subscription, SubscriptionManager
+from lib.stats import stats
+
+LAST_MIXER_FILE = os.path.expanduser('~/.xrem_mixer')
 
-class OSCClientServer(BlockingOSCUDPServer):
+class OSCClientServer(asyncio.DatagramProtocol):
     "The OSC communications agent"
     def __init__(self, address, dispatcher):
-        super().__init__(('', 0), dispatcher)
         self.xr_address = address
+        self.dispatcher = dispatcher
+        self.transport = None
+        self.waiters = {}  # OSC address -> futures waiting for a reply
+        self.routes = {}   # exact OSC address -> (handler, leading arguments)
+        self.capture = None # CaptureWriter recording every received datagram
+        self.taps = []      # callables also given every received datagram
+        self.heard = {}     # OSC address of a subscribed stream -> time.monotonic() last seen
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, client_address):
+        "Dispatch each message in a datagram and complete any query waiting for it."
+        if self.capture is not None:
+            self.capture.write(data)
+        for tap in self.taps:
+            tap(data)
+        try:
+            packet = OscPacket(data)
+        except ParseError:
+            if stats.enabled:
+                stats.count('dropped unparsable')
+            return
+        heard = self.heard
+        for timed_msg in packet.messages:
+            message = timed_msg.message
+            if message.address in heard:
+                heard[message.address] = time.monotonic()
+            if stats.enabled:
+                self.dispatch_timed(message, client_address)
+            else:
+                self.dispatch(message, client_address)
+            waiters = self.waiters.pop(message.address, None)
+            if waiters is not None:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(message.params)
+
+    def dispatch(self, message, client_address):
+        "Call the handlers for one message."
+        route = self.routes.get(message.address)
+        if route is not None:
+            route[0](*route[1], *message.params)
+        else:     # not known in advance, match the dispatcher patterns
+            for handler in self.dispatcher.handlers_for_address(message.address):
+                handler.invoke(client_address, message)
+
+    def dispatch_timed(self, message, client_address):
+        "dispatch counting messages per address family and timing the handler"
+        stats.count('rx /' + message.address.split('/', 2)[1])
+        route = self.routes.get(message.address)
+        name = route[0].__name__ if route is not None else 'dispatcher'
+        start = time.perf_counter()
+        self.dispatch(message, client_address)
+        stats.add('handler ' + name, time.perf_counter() - start)
 
     def send_message(self, address, value):
         "Packs a message for sending via OSC over UDB."
@@ -31,166 +92,389 @@ class OSCClientServer(BlockingOSCUDPServer):
         for val in values:
             builder.add_arg(val)
         msg = builder.build()
-        self.socket.sendto(msg.dgram, self.xr_address)
+        self.transport.sendto(msg.dgram, self.xr_address)
+
+    async def query(self, address, timeout, retries=0, value=None, reply=None):
+        """
+        Send address with value and return the parameters of the first message
+        to reply, by default address itself, sent again on timeout.
+        """
+        reply = reply or address
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(reply, []).append(waiter)
+        try:
+            for _ in range(retries + 1):
+                self.send_message(address, value)
+                try:
+                    return await asyncio.wait_for(asyncio.shield(waiter), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            raise asyncio.TimeoutError(address)
+        finally:
+            waiters = self.waiters.get(reply)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[reply]
+
+class StateSync:
+    """
+    Sends a list of queries keeping a bounded number in flight.
+
+    A query is complete when a message with the same OSC address is received,
+    queries without a reply are sent again after the timeout. Connect time is
+    then bound by the round trip time rather than by fixed sleeps.
+    """
+    def __init__(self, server, queries, window=1, timeout=0.5, retries=3, progress=None):
+        self.server = server
+        self.queries = queries
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.progress = progress
+        self.done = 0
+
+    async def run(self):
+        "send all queries and wait for the replies, returns the unanswered addresses"
+        window = asyncio.Semaphore(self.window)
+        failed = []
+
+        async def fetch(address):
+            async with window:
+                try:
+                    await self.server.query(address, self.timeout, self.retries)
+                except asyncio.TimeoutError:
+                    failed.append(address)
+                    return
+            self.done += 1
+            if self.progress is not None:
+                self.progress(self.done, len(self.queries))
+
+        await asyncio.gather(*(fetch(address) for address in self.queries))
+        return failed
+
+def initial_queries():
+    "OSC addresses of the state shown by the display"
+    queries = []
+    for channel in range(17):
+        queries.append('/ch/{:0>2d}/config/name'.format(channel + 1))
+        queries.append('/ch/{:0>2d}/config/color'.format(channel + 1))
+        queries.append('/ch/{:0>2d}/dyn/mgain'.format(channel + 1))
+        queries.append('/ch/{:0>2d}/dyn/ratio'.format(channel + 1))
+        queries.append('/ch/{:0>2d}/dyn/thr'.format(channel + 1))
+        queries.append('/headamp/{:0>2d}/gain'.format(channel + 1))
+    for channel in range(6):
+        queries.append('/bus/{:0>1d}/config/name'.format(channel + 1))
+        queries.append('/bus/{:0>1d}/dyn/ratio'.format(channel + 1))
+        queries.append('/bus/{:0>1d}/dyn/thr'.format(channel + 1))
+    queries.append('/rtn/aux/config/name')
+    queries.append('/rtn/aux/mix/fader')
+    queries.append('/lr/mix/fader')
+    queries.append('/lr/dyn/thr')
+    queries.append('/lr/dyn/ratio')
+    return queries
 
 class XAirClient:
     """
     Handles the communication with the X-Air mixer via the OSC protocol
+
+    Receive, keep alive and queries all run as tasks on one asyncio event loop
+    in a single thread, the other threads only hand work to it.
     """
     _CONNECT_TIMEOUT = 0.5
-    _WAIT_TIME = 0.002
-    _REFRESH_TIMEOUT = 5
+    _SYNC_WINDOW = 16   # initial state queries in flight at once
+    _SYNC_TIMEOUT = 0.1 # before an initial state query is sent again
+    _SUBSCRIPTION_TIME = 10  # the mixer drops subscriptions not renewed within
+    _RENEW_MARGIN = 1        # two renewals fit in the time less this, so one may be lost
+    _FORMAT_TIMEOUT = 0.3    # before a /formatsubscribe is sent again
 
     XAIR_PORT = 10024
 
     info_response = []
+    meter_banks = [2, 5]   # subscribed by refresh_connection, 1 is channel input
+    queries = None         # addresses read on connect in this order, initial_queries() if None
+    formats = None         # FormatGroups read by format subscription instead of queries
 
-    def __init__(self, address, state):
+    def __init__(self, address, state, port=XAIR_PORT):
         self.state = state
+        self.tasks = set()
+        self.closing = False
+        self.subscriptions = None   # SubscriptionManager, created on the event loop
         dispatcher = Dispatcher()
         dispatcher.map("/meters/*", self.state.received_meters)
         dispatcher.map("/xinfo", self.msg_handler)
         dispatcher.map("/-*", self.null_handler)
         dispatcher.map("/rtn*", self.null_handler)
         dispatcher.map("/*/*/automix*/*", self.null_handler)
-        dispatcher.map("/headamp*", self.state.headamp_handler)
-        dispatcher.map("/*/*/*/fader", self.state.fader_handler)
-        dispatcher.map("/*/*/dyn/*", self.state.dynamics_handler)
-        dispatcher.map("/*/*/config/name", self.state.name_handler)
-        dispatcher.map("/ch/*/config/color", self.state.color_handler)
-        dispatcher.map("/lr/*/*", self.state.lr_handler)
+        # the parameters shown are routed by exact address, drop the rest
+        dispatcher.map("/headamp*", self.null_handler)
+        dispatcher.map("/*/*/*/fader", self.null_handler)
+        dispatcher.map("/*/*/dyn/*", self.null_handler)
+        dispatcher.map("/*/*/config/*", self.null_handler)
+        dispatcher.map("/lr/*/*", self.null_handler)
         dispatcher.set_default_handler(self.msg_handler)
-        self.server = OSCClientServer((address, self.XAIR_PORT), dispatcher)
-        worker = threading.Thread(target=self.run_server)
-        worker.daemon = True
-        worker.start()
+        self.server = OSCClientServer((address, port), dispatcher)
+        for (osc_address, handler, args) in self.state.osc_routes():
+            self.server.routes[osc_address] = (handler, args)
+        self.loop = asyncio.new_event_loop()
+        self.worker = threading.Thread(target=self.run_server)
+        self.worker.daemon = True
+        self.worker.start()
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+
+    async def open(self):
+        "Bind the UDP socket used for all communication with the mixer."
+        await self.loop.create_datagram_endpoint(lambda: self.server,
+                                                 local_addr=('0.0.0.0', 0))
+        self.subscriptions = SubscriptionManager(self.server.send_message,
+                                                 self._SUBSCRIPTION_TIME, self._RENEW_MARGIN,
+                                                 self.server.heard)
+
+    def spawn(self, coro):
+        "Run coro as a task on the event loop, cancelled by stop_server."
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
 
     def start_connection(self):
-        "Confirm that the connection to the XAir is live, otherwise initiaties shutdown."
-        self.send('/xinfo')
-        time.sleep(self._CONNECT_TIMEOUT)
-        if len(self.info_response) > 0:
-            print('Successfully connected to %s with firmware %s at %s.' % (self.info_response[2],
-                    self.info_response[3], self.info_response[0]))
-            self.state.xair_button.text = self.info_response[0]
-            # now start polling refresh /xremote command while running
-            xair_thread = threading.Thread(target=self.refresh_connection)
-            xair_thread.daemon = True
-            xair_thread.start()
-
-            # read_initial_state
-            for channel in range(17):
-                self.send('/ch/{:0>2d}/config/name'.format(channel + 1)) #working
-                time.sleep(self._WAIT_TIME)
-                self.send('/ch/{:0>2d}/config/color'.format(channel + 1)) #working
-                time.sleep(self._WAIT_TIME)
-                self.send('/ch/{:0>2d}/dyn/mgain'.format(channel + 1)) #working
-                time.sleep(self._WAIT_TIME)
-                self.send('/ch/{:0>2d}/dyn/ratio'.format(channel + 1))
-                time.sleep(self._WAIT_TIME)
-                self.send('/ch/{:0>2d}/dyn/thr'.format(channel + 1))
-                time.sleep(self._WAIT_TIME)
-                self.send('/headamp/{:0>2d}/gain'.format(channel + 1)) #working
-                time.sleep(self._WAIT_TIME)
-            for channel in range(6):
-                self.send('/bus/{:0>1d}/config/name'.format(channel + 1)) #working
-                time.sleep(self._WAIT_TIME)
-                self.send('/bus/{:0>1d}/dyn/ratio'.format(channel + 1))
-                time.sleep(self._WAIT_TIME)
-                self.send('/bus/{:0>1d}/dyn/thr'.format(channel + 1))
-                time.sleep(self._WAIT_TIME)
-            self.send('/rtn/aux/config/name') #working
-            time.sleep(self._WAIT_TIME)
-            self.send('/rtn/aux/mix/fader')
-            time.sleep(self._WAIT_TIME)
-            self.send('/lr/mix/fader')
-            time.sleep(self._WAIT_TIME)
-            self.send('/lr/dyn/thr')
-            time.sleep(self._WAIT_TIME)
-            self.send('/lr/dyn/ratio')
-            time.sleep(self._WAIT_TIME)
+        """
+        Confirm that the connection to the XAir is live and read the initial state
+        in the background. Reports back through the state object from the event
+        loop thread: connected(info), sync_progress(done, total) and
+        sync_done(failed) or connect_failed() which also shuts the connection down.
+        """
+        self.loop.call_soon_threadsafe(self.spawn, self.connect())
 
-        else:
+    async def connect(self):
+        "Connect and read the initial state."
+        try:
+            self.info_response = await self.query('/xinfo', self._CONNECT_TIMEOUT, retries=4)
+        except asyncio.TimeoutError:
             print('Error: Failed to setup OSC connection to mixer.',
                   'Please check for correct ip address.')
-            self.state.quit_called = True
-            if self.server is not None:
-                self.server.shutdown()
-                self.server = None
+            self.stop_server()
+            self.state.connect_failed()
+            return
+        print('Successfully connected to %s with firmware %s at %s.' % (self.info_response[2],
+                self.info_response[3], self.info_response[0]))
+        self.state.connected(self.info_response)
+        # now keep /xremote and the meters subscribed while running
+        self.spawn(self.refresh_connection())
+
+        # read_initial_state, by format subscription where the mixer supports it
+        covered = await self.subscribe_formats()
+        queries = [address for address in self.queries or initial_queries()
+                   if address not in covered]
+        sync = StateSync(self.server, queries, window=self._SYNC_WINDOW,
+                         timeout=self._SYNC_TIMEOUT, progress=self.state.sync_progress)
+        failed = await sync.run()
+        if failed:
+            print('Warning: no reply for %d queries: %s' % (len(failed), ', '.join(failed)))
+        self.state.sync_done(failed)
+
+    async def subscribe_formats(self):
+        """
+        Start a format subscription for each of formats, returns the addresses
+        covered by those the mixer answered. The rest are left to queries.
+        """
+        async def start(group):
+            self.server.routes[group.alias] = (group.received, ())
+            try:
+                await self.server.query('/formatsubscribe', self._FORMAT_TIMEOUT, retries=1,
+                                        value=group.request(), reply=group.alias)
+            except asyncio.TimeoutError:
+                del self.server.routes[group.alias]
+                return []
+            self.subscriptions.add(Subscription(group.alias, '/formatsubscribe',
+                                                group.request(), ('/renew', [group.alias]),
+                                                watch=group.alias),
+                                   sent=True)
+            return group.addresses
+
+        covered = set()
+        for addresses in await asyncio.gather(*(start(group) for group in self.formats or ())):
+            covered.update(addresses)
+        if self.formats and not covered:
+            print('No reply to /formatsubscribe, reading the state by query')
+        return covered
+
+    def start_capture(self, path):
+        "Append every datagram received from now on to the capture file at path."
+        self.loop.call_soon_threadsafe(setattr, self.server, 'capture', CaptureWriter(path))
+
+    def start_replay(self, path, speed=1.0):
+        """
+        Feed the datagrams of a capture file to the handlers instead of talking
+        to a mixer, at speed times the original rate or as fast as possible if 0.
+        """
+        async def run():
+            await replay_async(path, lambda data: self.server.datagram_received(data, None),
+                               speed)
+            print('Replay of %s finished' % path)
+        self.loop.call_soon_threadsafe(self.spawn, run())
+
+    async def query(self, address, timeout=_CONNECT_TIMEOUT, retries=0):
+        "Send address to the mixer and return the parameters of its reply."
+        return await self.server.query(address, timeout, retries)
 
     def run_server(self):
-        "Start the OSC communications agent in a seperate thread."
+        "Run the event loop for the OSC communications agent in a seperate thread."
+        asyncio.set_event_loop(self.loop)
         try:
-            self.server.serve_forever()
-        except KeyboardInterrupt:
-            self.stop_server()
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
 
     def stop_server(self):
-        if self.server is not None:
-            self.server.shutdown()
-            self.server = None
-        # not needed for xair_thread which reads quit_called
+        "Cancel all tasks, close the socket and stop the event loop, safe from any thread."
+        if self.closing:
+            return
+        self.closing = True
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop)
+        if threading.current_thread() is not self.worker:
+            self.worker.join()
+
+    async def close(self):
+        "Wait for the cancelled tasks to finish before stopping the loop."
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.server.transport is not None:
+            self.server.transport.close()
+        if self.server.capture is not None:
+            print('Captured %d datagrams' % self.server.capture.count)
+            self.server.capture.close()
+            self.server.capture = None
+        self.loop.stop()
 
     def null_handler(self, addr, *data):
         "Drop known irrelevant OSC messages."
-        pass
+        if stats.enabled:
+            stats.count('dropped /' + addr.split('/', 2)[1])
 
     def msg_handler(self, addr, *data):
         "Dispatch received OSC messages based on message type."
-        if self.state is None or self.state.quit_called:
-            self.stop_server()
-            return
         if addr == '/xinfo':
             self.info_response = data[:]
         else:
+            if stats.enabled:
+                stats.count('unhandled /' + addr.split('/', 2)[1])
             print('OSCReceived("%s", %s)' % (addr, data))
 
-    def refresh_connection(self): # the thread to ping the XAir every _REFRESH_TIMEOUT
+    async def refresh_connection(self): # the task renewing each subscription as it lapses
         """
         Tells mixer to send changes in state that have not been received from this OSC Client
           /xremote        - all parameter changes are broadcast to all active clients (Max 4)
           /xremotenfb     - No Feed Back. Parameter changes are only sent to the active clients
                                                                 which didn't initiate the change
         """
+        self.subscriptions.add(Subscription('/xremote', '/xremote'))
+        for bank in self.meter_banks:
+            self.subscriptions.add(self.meter_subscription(bank))
         try:
-            while not self.state.quit_called and self.server is not None:
-                self.server.send_message("/xremote", None)
-#                self.send(address="/meters", param=["/meters/1"])
-                self.send(address="/meters", param=["/meters/2"])
-                self.send(address="/meters", param=["/meters/5"])
-                time.sleep(self._REFRESH_TIMEOUT)
-                if self.state.quit_called:
-                    self.stop_server()
-                    return
+            await self.subscriptions.run()
         except socket.error:
             self.stop_server()
 
+    @staticmethod
+    def meter_subscription(bank):
+        return Subscription('/meters/%d' % bank, '/meters', ['/meters/%d' % bank],
+                            watch='/meters/%d' % bank)
+
+    def subscribe_meters(self, bank, on=True):
+        "Add or drop a meter bank from the subscriptions, a dropped bank stops within 10s"
+        if on and bank not in self.meter_banks:
+            self.meter_banks = self.meter_banks + [bank]
+            self.call(self.subscriptions.add, self.meter_subscription(bank))
+        elif not on and bank in self.meter_banks:
+            self.meter_banks = [b for b in self.meter_banks if b != bank]
+            self.call(self.subscriptions.remove, '/meters/%d' % bank)
+
+    def call(self, function, *args):
+        "Run function on the event loop thread, now if already on it"
+        if threading.current_thread() is self.worker:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
     def send(self, address, param=None):
-        "Call the OSC agent to send a message"
-        self.server.send_message(address, param)
+        "Call the OSC agent to send a message, safe from any thread"
+        self.call(self.server.send_message, address, param)
 
-def find_mixer():
-    "Search for the IP address of the XAir mixer"
+def last_mixer(path=LAST_MIXER_FILE):
+    "The address of the mixer connected to last time, None if not known"
+    try:
+        with open(path) as file:
+            return file.read().strip() or None
+    except OSError:
+        return None
+
+def remember_mixer(address, path=LAST_MIXER_FILE):
+    "Keep the mixer address for the next search"
+    try:
+        with open(path, 'w') as file:
+            file.write(address + '\n')
+    except OSError as error:
+        print('Warning: could not save the mixer address:', error)
+
+def find_mixers(timeout=2.0, window=0.3, port=XAirClient.XAIR_PORT, known=None):
+    """
+    Search for XAir mixers, returns a list of (ip, name, model, firmware).
+
+    /xinfo is sent straight to the last known mixer and broadcast on every
+    interface at the same time. The search ends as soon as the known mixer
+    answers, otherwise window seconds after the first reply so every mixer on
+    the network is listed, or after timeout if nothing answers.
+    """
     print('Searching for mixer...')
+    if known is None:
+        known = last_mixer()
     client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, True)
-    client.settimeout(5)
+    request = "/xinfo\0\0".encode()
+    targets = [known] if known else []
     for iface in netifaces.interfaces():
         try:
-            bcast = netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['broadcast']
-            client.sendto("/xinfo\0\0".encode(), (bcast, XAirClient.XAIR_PORT))
-        except:
+            targets.append(netifaces.ifaddresses(iface)[netifaces.AF_INET][0]['broadcast'])
+        except (KeyError, IndexError):
+            pass
+    for target in targets:
+        try:
+            client.sendto(request, (target, port))
+        except OSError:
             pass
+    mixers = {}
+    deadline = time.monotonic() + timeout
     try:
-        response = OscMessage(client.recv(512))
-    except socket.timeout:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            client.settimeout(remaining)
+            try:
+                (data, (address, _)) = client.recvfrom(512)
+                response = OscMessage(data)
+            except socket.timeout:
+                break
+            except MessageParseError:
+                continue
+            if response.address != '/xinfo' or address in mixers:
+                continue
+            mixers[address] = (address,) + tuple(response.params[1:4])
+            print('Found %s with firmware %s on IP %s' % (response.params[2],
+                  response.params[3], address))
+            if address == known:
+                break
+            deadline = min(deadline, time.monotonic() + window)
+    finally:
+        client.close()
+    if not mixers:
         print('No server found')
-        return None
-    client.close()
+    return list(mixers.values())
 
-    if response.address != '/xinfo':
-        print('Unknown response')
-        return None
-    else:
-        print('Found ' + response.params[2] + ' with firmware ' + response.params[3] + ' on IP ' + response.params[0])
-        return response.params[0]
+def find_mixer():
+    "Search for the IP address of the XAir mixer"
+    mixers = find_mixers()
+    return mixers[0][0] if mixers else None
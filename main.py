@@ -1,3 +1,6 @@
+import time
+started = time.perf_counter()  # for --profile-startup
+
 import kivy
 kivy.require('2.0.0')
 
@@ -12,17 +15,30 @@ Config.set('graphics', 'fullscreen', 'auto')
 from kivy.app import App
 from kivy.uix.widget import Widget
 from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.button import Button
+from kivy.uix.popup import Popup
 from kivy.properties import (
     NumericProperty, ReferenceListProperty, ListProperty, ObjectProperty, StringProperty
 )
 from kivy.core.window import Window
+from kivy.clock import Clock
+from kivy.lang import Builder
 import os
-import struct
 import datetime
-import subprocess
-from lib.xair import XAirClient, find_mixer
+# lib.xair, lib.ballistics and lib.spectrum are imported when first needed, after
+# the first frame, as networking and numpy are slow to load on a Pi
+from lib.meters import decode_meters, METER_ROUTES, RTA_BANK, MeterBuffer, MeterScale
+from lib.textcache import RotatedText # used by strip.kv
+from lib.mixer import FORMATS, MixerState, display_params, strip_labels
+from lib.stats import stats, PhaseTimer
+from lib.history import MeterHistory
+import argparse
+import itertools
 import sys
 
+startup = PhaseTimer(started)
+startup.mark('import')
+
 red = [.8, 0, 0, 1]
 rred = [1, 0, 0, 1]
 green = [0, .5, 0, 1]
@@ -35,7 +51,6 @@ orange = [1, .6, 0, 1]
 white = [1, 1, 1, 1]
 gray = [1, 1, 1, 1]
 colors = [gray,rred,ggreen,yellow,bblue,purple,orange,white]
-ratios = [1.1, 1.3, 1.5, 2.0, 2.5, 3.0, 4.0, 5.0, 7.0, 10, 20, 100]
 
 class ChannelData(BoxLayout):
     "Data structure to represent a Channel Meter Display"
@@ -50,6 +65,13 @@ class ChannelData(BoxLayout):
     in_percent = NumericProperty(1)
     out_percent = NumericProperty(1)
     post_percent = NumericProperty(0)
+    # height and color of the peak hold marker, 0 hides it, red once clipped
+    in_peak = NumericProperty(0)
+    out_peak = NumericProperty(0)
+    post_peak = NumericProperty(0)
+    in_peak_color = ListProperty(white)
+    out_peak_color = ListProperty(white)
+    post_peak_color = ListProperty(white)
     # additional properties for the channel
     gain = StringProperty("0")
     ratio = StringProperty("0")
@@ -61,81 +83,284 @@ class ChannelData(BoxLayout):
 
     # meter values are sent as 16bit signed int mapped to -128db to 128db
     # 1/256 db resolution, aka .004 dB, values max at 0db
+    # the scale is shifted by 35 DB to make the scale look right, red is close to
+    # clipping, blue is low and dark blue very low
+    scale = MeterScale(ggreen, hot=(-7, red), low=((-17, bblue), (-27, blue)), shift=35)
+
     def scale_value(self, value):
         "scales 16bit unsigned meter value for display"
-        color = ggreen     # default color if good
-        value = value/256  # convert to DB
-        color = ggreen     # default color
-        if value > -7:
-            color = red    # close to clipping
-        elif value < -17:
-            color = bblue   # color if low
-        if value < -27:
-            color = blue  # color if very low
-
-        value = value + 35  # shift by 35 DB to make the sale look right
-        if value < 0:
-            value = 0
-        return (value / 35, color)  # scale to between 0 and 1
+        i = self.scale.index(value)
+        return (self.scale.fraction[i], self.scale.color[i])
 
     def debug_value(self, value):
-        value = value/256  # convert to DB and shift by 60 DB
-        if value < -70:       #floor the value at -70 db
-            return ""
-        return f"{value:.1f} dB"
+        return self.scale.label[self.scale.index(value)]
 
     #updated meter value based on 16 bit unsigned value showing
     #-128db to +128db in db/256 increments
     def update_in(self, value):
-        (self.in_percent, self.in_color) = self.scale_value(value)
-#        self.level = self.debug_value(value)
+        i = self.scale.index(value)
+        self.in_percent = self.scale.fraction[i]
+        self.in_color = self.scale.color[i]
+#        self.level = self.scale.label[i]
 
     def update_out(self, value):
-        (self.out_percent, self.out_color) = self.scale_value(value)
-        self.level = self.debug_value(value)
+        i = self.scale.index(value)
+        self.out_percent = self.scale.fraction[i]
+        self.out_color = self.scale.color[i]
+        self.level = self.scale.label[i]
 
     def update_post(self, value):
-        (self.post_percent, self.post_color) = self.scale_value(value)
-        self.level_out = self.debug_value(value)
+        i = self.scale.index(value)
+        self.post_percent = self.scale.fraction[i]
+        self.post_color = self.scale.color[i]
+        self.level_out = self.scale.label[i]
+
+    def update_in_peak(self, value, clip):
+        self.in_peak = self.scale.fraction[self.scale.index(value)]
+        self.in_peak_color = rred if clip else white
+
+    def update_out_peak(self, value, clip):
+        self.out_peak = self.scale.fraction[self.scale.index(value)]
+        self.out_peak_color = rred if clip else white
+
+    def update_post_peak(self, value, clip):
+        self.post_peak = self.scale.fraction[self.scale.index(value)]
+        self.post_peak_color = rred if clip else white
+
+    def updaters(self):
+        "update methods indexed by meter slot: in, out, post"
+        return (self.update_in, self.update_out, self.update_post)
+
+    def peak_updaters(self):
+        "peak update methods indexed by meter slot: in, out, post"
+        return (self.update_in_peak, self.update_out_peak, self.update_post_peak)
 
 class XRemGUI(Widget):
     channels = ObjectProperty(None) # kivy storage for channels
     buses = ObjectProperty(None)    # kivy storage for buses
     xair_button = ObjectProperty(None) # kivy storage for button
+    stats_label = ObjectProperty(None) # kivy storage for the performance overlay
+    rta = None                      # spectrum panel, created when first shown
+    stats_file = "xrem_stats.txt"   # performance counters are written here on quit
     channel_data = []               # python storage for channels and buses
+    meter_routes = {}               # meter bank -> [(value index, buffer index)]
+    meter_buffer = None             # latest meter values waiting for the next frame
+    meter_updaters = []             # strip update methods indexed by buffer index
+    peak_updaters = []              # strip peak update methods indexed by buffer index
+    ballistics = None               # smooths the meters when numpy is available
+    history = None                  # recent meter values for summaries
+    mixer_state = None              # raw values of the parameters shown
+    param_targets = []              # ((strip, attribute, format), ...) per mixer state slot
+    state_file = os.path.expanduser('~/.xrem_state.json') # mixer state kept between runs
+    use_ballistics = True
+    use_worker = False              # connect from a worker process sharing memory
+    shared = None                   # SharedState with the worker
+    strips_per_frame = 4            # strips built per frame when building incrementally
+    strip_rules = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'strip.kv')
+    profile_startup = False
     # xair connection info
     xair_address = None
+    xair_port = None                # the XAir port unless given
     xair_client = None
-
-    # setup for recording xair audio
-    rec_proc = 0
-    my_env = os.environ.copy()
-    my_env['AUDIODEV'] = 'plughw:CARD=X18XR18'
-    record_command = ['rec', '-q', '-c', '18', '-b', '24']
-#    record_command = ['rec', '-c', '18', '-b', '24']
-    record_file = ""
+    capture_file = None             # record the received OSC stream to this file
+    replay_file = None              # play this OSC capture instead of connecting
+    replay_speed = 1.0
+
+    # recording the xair audio
+    recorder = None                 # Recorder while recording
+    record_dir = '/home/pi/recordings'
+#    record_dir = '/media/pi/ExternalSSD'
+    record_source = 'alsa'          # alsa, synthetic or a raw or WAV file to record
+    record_tracks = False           # a mono file per channel instead of one of 18 channels
+    record_event = None             # updates the counters on the Record button
  
-    def paint_buttons(self):
-        for x in range(16):     # Create the 16 channels strips.
-            self.channel_data.append(ChannelData(in_text = f'{x+1}',
-                                    out_text = f'Ch {x+1}'))
-            self.channels.add_widget(self.channel_data[x])
-
-        self.channel_data.append(ChannelData(in_percent = 0, 
-                                in_text = f'Aux L', 
-                                out_text = f'Aux R'))
-        self.buses.add_widget(self.channel_data[16])
-
-        for x in range(3):      # Create 6 Output Bus
-            self.channel_data.append(ChannelData(in_percent = 0,
-                                    in_text = f'Bus {2*x+1}', 
-                                    out_text = f'Bus {2*x+2}'))
-            self.buses.add_widget(self.channel_data[17+x])
-
-        self.channel_data.append(ChannelData(in_color = [0,0,0,1], 
-                                in_text = f'Main L', 
-                                out_text = f'Main R'))
-        self.buses.add_widget(self.channel_data[20])
+    def strip_specs(self):
+        "(strip arguments, parent widget) for every strip in display order"
+        for (x, (left, right)) in enumerate(strip_labels()):
+            kwargs = dict(in_text = left, out_text = right)
+            if x >= 16:     # Aux in, the 6 output buses and Main LR
+                kwargs['in_percent'] = 0
+            if x == 20:
+                kwargs['in_color'] = [0,0,0,1]
+            yield (kwargs, self.channels if x < 16 else self.buses)
+
+    def paint_buttons(self, meter_bridge=False, incremental=False):
+        """
+        Create the strips, with incremental a few per frame so the window shows
+        before they are all built.
+        """
+        if meter_bridge:
+            self.paint_bridge()
+            return
+        specs = self.strip_specs()
+
+        def add_strips(count):
+            "add up to count strips, True once all are added"
+            if self.strip_rules not in Builder.files:    # once per process
+                Builder.load_file(self.strip_rules)
+            for (kwargs, parent) in itertools.islice(specs, count):
+                self.channel_data.append(ChannelData(**kwargs))
+                parent.add_widget(self.channel_data[-1])
+            if len(self.channel_data) < 21:
+                return False
+            startup.mark('strips')
+            self.route_meters()
+            self.route_params()
+            return True
+
+        if not incremental:
+            add_strips(21)
+            return
+        def build(dt):
+            if add_strips(self.strips_per_frame):
+                return False    # unschedule
+        Clock.schedule_interval(build, 0)
+
+    def paint_bridge(self):
+        "Create the strips as StripState drawn by one MeterBridge per panel."
+        from lib.meterbridge import MeterBridge, StripState
+        scale = ChannelData.scale
+        for (kwargs, parent) in self.strip_specs():
+            self.channel_data.append(StripState(scale, **kwargs))
+        self.channels.cols = 1
+        self.channels.add_widget(MeterBridge(self.channel_data[:16], cols=8))
+        self.buses.add_widget(MeterBridge(self.channel_data[16:], cols=5))
+        startup.mark('strips')
+        self.route_meters()
+        self.route_params()
+
+    def warm_up(self, dt=None):
+        "load the networking stack once the first frame is up and the strips are built"
+        if self.meter_buffer is None:
+            Clock.schedule_once(self.warm_up, 0)
+            return
+        import lib.xair
+        startup.mark('networking')
+        if self.profile_startup:
+            print('Startup profile:')
+            print('\n'.join(startup.report()))
+
+    def route_meters(self):
+        "bind the meter routing table to the meter buffer and strip update methods"
+        if self.use_worker:
+            from lib.worker import SharedState
+            self.shared = SharedState(len(self.channel_data), len(display_params()))
+            self.meter_buffer = self.shared.meters
+        else:
+            self.meter_buffer = MeterBuffer(len(self.channel_data))
+        self.history = MeterHistory(self.meter_buffer.size)
+        self.meter_updaters = [update for strip in self.channel_data
+                               for update in strip.updaters()]
+        self.peak_updaters = [update for strip in self.channel_data
+                              for update in strip.peak_updaters()]
+        if self.use_ballistics:
+            from lib.ballistics import Ballistics
+            if Ballistics.available():
+                self.ballistics = Ballistics(self.meter_buffer.values)
+            else:
+                print('numpy is not installed, meters are shown without ballistics')
+        self.meter_routes = {}
+        for (bank, routes) in METER_ROUTES.items():
+            self.meter_routes[bank] = [(i, strip * 3 + slot) for (i, strip, slot) in routes]
+        Clock.schedule_interval(self.apply_meters, 0) # once per frame
+        startup.mark('meter routing')
+
+    def route_params(self):
+        "bind the mixer state slots to the strip attributes showing them"
+        params = display_params()
+        self.mixer_state = MixerState(params)
+        formats = dict(FORMATS, color=lambda v: colors[int(v) % 8])
+        self.param_targets = [tuple((self.channel_data[strip], attr, formats[kind])
+                                    for (strip, attr, kind) in targets)
+                              for targets in params.values()]
+        if self.mixer_state.load(self.state_file):
+            startup.mark('last mixer state')
+        Clock.schedule_interval(self.apply_params, 0) # once per frame
+
+    def apply_params(self, dt):
+        "show the parameters that changed since the last frame, runs on the UI thread"
+        if self.shared is not None and self.xair_client is not None:
+            self.xair_client.poll()     # the worker's events, meter frame and parameters
+        targets = self.param_targets
+        for (slot, value) in self.mixer_state.changes():
+            if value != "":
+                for (strip, attr, fmt) in targets[slot]:
+                    setattr(strip, attr, fmt(value))
+
+    def apply_meters(self, dt):
+        "apply the meter values received since the last frame, runs on the UI thread"
+        if stats.enabled:
+            stats.add('ui frame', dt)
+            start = time.perf_counter()
+            depth = self.update_meters(dt)
+            stats.add('meters applied', time.perf_counter() - start)
+            stats.add('meters queue depth', depth, unit=1)
+        else:
+            self.update_meters(dt)
+
+    def update_meters(self, dt):
+        "update the bars that changed, returns how many"
+        updaters = self.meter_updaters
+        if self.ballistics is None:
+            depth = 0
+            for (index, value) in self.meter_buffer.drain():
+                updaters[index](value)
+                depth += 1
+            return depth
+        self.meter_buffer.clear()
+        ballistics = self.ballistics
+        changed = ballistics.advance(dt)
+        for index in changed:
+            updaters[index](ballistics.raw_level(index))
+            self.peak_updaters[index](ballistics.raw_peak(index), ballistics.clip[index])
+        return len(changed)
+
+    def show_rta(self, state):
+        "toggle the spectrum panel and its meter subscription"
+        on = state == "down"
+        if on and self.rta is None:
+            from lib.spectrum import SpectrumView
+            self.rta = SpectrumView()
+            self.ids.rta_box.add_widget(self.rta)
+        self.ids.rta_box.size_hint_y = .4 if on else 0
+        if self.rta is not None:
+            self.rta.opacity = 1 if on else 0
+        if self.xair_client is not None:
+            self.xair_client.subscribe_meters(RTA_BANK, on)
+
+    def reset_clip(self):
+        "clear the clip latch on every bar"
+        if self.ballistics is not None:
+            self.ballistics.reset_clip()
+
+    def show_stats(self, state):
+        "toggle collecting the performance counters and showing them over the strips"
+        if state == "down":
+            stats.reset()
+            stats.enabled = True
+            self.stats_label.opacity = 1
+            self.refresh_stats(0)
+            Clock.schedule_interval(self.refresh_stats, 1)
+        else:
+            stats.enabled = False
+            self.stats_label.opacity = 0
+            Clock.unschedule(self.refresh_stats)
+
+    def refresh_stats(self, dt):
+        lines = stats.report()
+        if self.history is None:    # strips still being built
+            self.stats_label.text = '\n'.join(lines)
+            return
+        for (peak, index) in self.history.loudest(10, 3):
+            lines.append('loudest 10 s %-12s %s' % (self.meter_name(index),
+                                                   ChannelData.scale.label[ChannelData.scale.index(peak)]))
+        self.stats_label.text = '\n'.join(lines)
+
+    def meter_name(self, index):
+        "strip name and bar of a meter buffer index"
+        (strip, slot) = divmod(index, 3)
+        strip = self.channel_data[strip]
+        return '%s %s' % (strip.out_text if slot else strip.in_text, ('in', 'out', 'post')[slot])
 
 # the meter subscription is setup in the xair_client in the refresh method that runs
 # every 5s a subscription sends values every 50ms for 10s
@@ -146,211 +371,176 @@ class XRemGUI(Widget):
     def received_meters(self, addr, *data):
         "receive an OSC Meters packet"
         meter_num = int(addr.split('/',)[-1]) # last element of OSC path
-        data_size = struct.unpack("<L", data[0][0:4])[0]
-        for i in range(data_size):
-            value = struct.unpack("<h", data[0][(4+(i*2)):4+((i+1)*2)])[0]
-
-            if meter_num == 2:   # inputs
-                if i < 16:       # 16 inputs and 2 Aux
-                    self.channel_data[i].update_in(value)
-                if i == 16:       # Aux L
-                    self.channel_data[i].update_out(value)
-                if i == 17:       # Aux R
-                    self.channel_data[i-1].update_post(value)
-#            elif meter_num == 1: # channel input
-#                if i > 15:       # skip 16 inputs
-#                   if i < 17:       # Aux L
-#                        self.channel_data[i].update_out(value)
-#                   elif i < 18:       # Aux R
-#                        self.channel_data[i-1].update_post(value)
-            elif meter_num == 5: # outputs
-                if i < 8:        # aux_out, main
-                    bus_num = int(i/2)
-                    ch_num = 17 + bus_num
-                    if i%2:
-                        self.channel_data[ch_num].update_post(value)
-                    else:
-                        self.channel_data[ch_num].update_out(value)
-                elif i < 24:
-                    ch_num = i - 8
-                    self.channel_data[ch_num].update_post(value)
-                elif i < 40:
-                    ch_num = i - 24
-                    self.channel_data[ch_num].update_out(value)
-            if i > 39:
-                break
-        # ignore other meter types
-
-    def name_handler(self, addr, *data):
-        "receive a channel/bus/aux name update"
-        elements = addr.split('/') # first three parts of the OSC path
-        if data[0] != "":
-            if elements[1] == "ch":
-                ch_num = int(elements[2])
-                self.channel_data[ch_num - 1].in_text = data[0]
-            elif elements[1] == "bus":
-                bus = int(elements[2])
-                ch_num = int((bus - 1)/2) + 17
-                if int(bus - 1)%2:
-                    self.channel_data[ch_num].out_text = data[0]
-                else:
-                    self.channel_data[ch_num].in_text = data[0]
-            elif elements[1] == "rtn" and elements[2] == "aux":
-                self.channel_data[16].in_text = "%s L" % data[0]
-                self.channel_data[16].out_text = "%s R" % data[0]
-        # ignore other names
-
-    def color_handler(self, addr, *data):
-        "receive a channel/bus/aux color update"
-        elements = addr.split('/') # first three parts of the OSC path
-        if data[0] != "":
-            if elements[1] == "ch":
-                ch_num = int(elements[2])
-                self.channel_data[ch_num - 1].color = colors[int(data[0])%8]
-        # ignore other colors
-
-    def dynamics_handler(self, addr, *data):
-        "receive a channel/bus/aux dynamics update"
-        elements = addr.split('/') # first three parts of the OSC path
-        if data[0] != "":
-            bus = 0
-            if elements[1] == "ch":
-                ch_num = int(elements[2]) - 1
-            elif elements[1] == "bus":
-                bus = int(elements[2])
-                ch_num = int((bus - 1)/2) + 17
-            elif elements[1] == "lr":
-                ch_num = 16
-            else:
-                return
-#            print(f" dynamics update: ch {ch_num}, {elements[3]}, {data}", file=sys.stderr)
-            if elements[4] == "mgain":
-                if bus in (1, 3, 5):
-                    # won't happen as mgain isn't sent by bus
-                    self.channel_data[ch_num].gain = f"mg {float(data[0])*24:.1f}"
-                else:
-                    self.channel_data[ch_num].mgain = f"mg {float(data[0])*24:.1f}"
-                return
-            elif elements[4] == "thr":
-                if bus in (1, 3, 5):
-                    self.channel_data[ch_num].gain = f"th {float(data[0])*60-60:.1f}"
-                else:
-                    self.channel_data[ch_num].thr = f"th {float(data[0])*60-60:.1f}"
-                return
-            elif elements[4] == "ratio":
-                if bus in (1, 3, 5):
-                    self.channel_data[ch_num].mgain = f"r {ratios[int(data[0])]}"
-                else:
-                    self.channel_data[ch_num].ratio = f"r {ratios[int(data[0])]}"
-                return
-        # ignore other dynamics
-
-    def scale_fader(self, data):
-        "convert fader float to dB"
-        f = float(data)
-        if f < 0.0625:
-            d = (480 * f) - 90
-        elif f < 0.25:
-            d = (160 * f) - 70
-        elif f < 0.5:
-            d = (80 * f) - 50
+        routes = self.meter_routes.get(meter_num)
+        if routes is None:
+            return                   # ignore other meter types
+        self.meter_handler(routes, data[0])
+
+    def osc_routes(self):
+        "(exact OSC address, handler, leading handler arguments) for the XAirClient routing index"
+        for (bank, routes) in self.meter_routes.items():
+            yield ('/meters/%d' % bank, self.meter_handler, (routes,))
+        yield ('/meters/%d' % RTA_BANK, self.rta_handler, ())
+        for (address, slot) in self.mixer_state.slots.items():
+            yield (address, self.mixer_state.set, (slot,))
+
+    def meter_handler(self, routes, blob):
+        "receive a routed OSC Meters packet"
+        # runs on the OSC server thread so only buffer the values for apply_meters
+        if stats.enabled:
+            start = time.perf_counter()
+            self.meter_buffer.store(routes, decode_meters(blob))
+            stats.add('meters decode', time.perf_counter() - start)
         else:
-            d = (40 * f) - 30
-        if d < -90: 
-            d = -90
-        if d > 10:
-            d = 10
-        return d
-
-    def lr_handler(self, addr, *data):
-        "receive a lr update"
-        elements = addr.split('/') # first three parts of the OSC path
-        if data[0] != "":
-            ch_num = 20
-            if elements[3] == "fader":
-                self.channel_data[20].gain = f"f {self.scale_fader(data[0]):.1f}"
-                self.channel_data[20].mgain = ""
-            elif elements[3] == "thr":
-                self.channel_data[ch_num].thr = f"th {float(data[0])*60-60:.1f}"
-            elif elements[3] == "ratio":
-                self.channel_data[ch_num].ratio = f"r {ratios[int(data[0])]}"
-            return
-    
-    def fader_handler(self, addr, *data):
-        "receive a fader update"
-        elements = addr.split('/') # first three parts of the OSC path
-        if data[0] != "":
-            if elements[1] == "rtn" and elements[2] == "aux" and elements[3] == "mix":
-                self.channel_data[16].mgain = f"f {self.scale_fader(data[0]):.1f}"
-                self.channel_data[16].thr = ""
-                self.channel_data[16].ratio = ""
-            return
+            self.meter_buffer.store(routes, decode_meters(blob))
+        self.history.record(self.meter_buffer.values)
 
-    def headamp_handler(self, addr, *data):
-        "receive a headamp update"
-        elements = addr.split('/') # first three parts of the OSC path
-        if data[0] != "":
-            if elements[3] == "gain":
-                ch_num = int(elements[2])
-                if ch_num < 17:
-                    self.channel_data[ch_num -1].gain = f"g {float(data[0])*72-12:.1f}"
-                else:
-                    self.channel_data[ch_num -1].gain = f"g {float(data[0])*32-12:.1f}"
+    def rta_handler(self, blob):
+        "receive an RTA packet, subscribed only once the panel has been shown"
+        if self.rta is not None:
+            self.rta.store(blob)
 
     def connect_mixer(self, state):
         if state: # == "down":
             if self.xair_client is not None:
                 return True
+            if self.meter_buffer is None:   # strips still being built, try again shortly
+                Clock.schedule_once(lambda dt: self.connect_mixer(state), .1)
+                return True
+            from lib.xair import XAirClient, find_mixers, last_mixer, initial_queries
+            from lib.subscriptions import format_groups
+            if self.use_worker:
+                from lib.worker import WorkerClient as XAirClient
             self.quit_called = False
+            if self.replay_file is not None:
+                self.xair_client = XAirClient('127.0.0.1', self)
+                self.xair_client.start_replay(self.replay_file, self.replay_speed)
+                self.xair_button.text = "Replay"
+                return True
             # determine the mixer address
             if self.xair_address is None:
-                self.xair_address = find_mixer()
-                if self.xair_address is None:
+                mixers = find_mixers()
+                if len(mixers) > 1:
+                    self.choose_mixer(mixers)
+                    return True
+                if mixers:
+                    self.xair_address = mixers[0][0]
+                else:
+                    self.xair_address = last_mixer() or "192.168.50.146"
                     print('Error: Could not find any mixers in network.',
-                        'Using default ip address.')
-                    self.xair_address = "192.168.50.146"
+                        'Using ip address %s.' % self.xair_address)
 
             # setup other modules
-            self.xair_client = XAirClient(self.xair_address, self)
-            self.xair_client.start_connection()
-            if self.quit_called:
-                self.xair_client = None
-                return False
+            if self.xair_port is None:
+                self.xair_client = XAirClient(self.xair_address, self)
+            else:
+                self.xair_client = XAirClient(self.xair_address, self, self.xair_port)
+            # the values not known from the last run first, unchanged ones touch nothing
+            self.xair_client.queries = sorted(initial_queries(), key=self.mixer_state.known)
+            self.xair_client.formats = format_groups(self.mixer_state)
+            if self.rta is not None and self.rta.opacity:
+                self.xair_client.subscribe_meters(RTA_BANK)
+            if self.capture_file is not None:
+                self.xair_client.start_capture(self.capture_file)
+            self.xair_client.start_connection() # completes in the background
             return True
         else:
             if self.xair_client is not None:
                 self.xair_client.stop_server()
                 self.xair_client = None
 
+# connection progress is reported from the XAirClient sync thread so hand it over
+# to the UI thread before touching any widgets
+    def choose_mixer(self, mixers):
+        "ask which of several mixers found to connect to"
+        choices = BoxLayout(orientation='vertical', spacing=4)
+        popup = Popup(title='Choose a mixer', content=choices, size_hint=(.5, .6))
+        def choose(address):
+            popup.dismiss()
+            self.xair_address = address
+            self.connect_mixer(True)
+        for (address, name, model, firmware) in mixers:
+            button = Button(text='%s  %s %s  %s' % (name, model, firmware, address))
+            button.bind(on_release=lambda button, address=address: choose(address))
+            choices.add_widget(button)
+        popup.open()
+
+    def connected(self, info):
+        "the mixer answered /xinfo"
+        if self.xair_port is None:
+            from lib.xair import remember_mixer
+            remember_mixer(self.xair_address)
+        Clock.schedule_once(lambda dt: setattr(self.xair_button, 'text', info[0]))
+
+    def sync_progress(self, done, total):
+        "part of the initial state has been received"
+        Clock.schedule_once(lambda dt: setattr(self.xair_button, 'text',
+                                               f'Sync {done}/{total}'))
+
+    def sync_done(self, failed):
+        "the initial state has been received, failed lists unanswered queries"
+        info = self.xair_client.info_response if self.xair_client else ["XAir"]
+        Clock.schedule_once(lambda dt: setattr(self.xair_button, 'text', info[0]))
+
+    def connect_failed(self):
+        "the mixer did not answer or the worker went away, shut the client down"
+        def reset(dt):
+            if self.xair_client is not None:
+                self.xair_client.stop_server()  # joins a worker and closes its pipe
+                self.xair_client = None
+            self.xair_button.text = "Connect XAir"
+        Clock.schedule_once(reset)
+
     def record(self, state):
-        print("record start %s" % state)
-        if state: # == "down":
-            print("mid %s" % self.rec_proc)
-            print(self.record_command)
-            if self.rec_proc == 0:
-                print("starting %s" % state)
-#                    self.record_file = '/media/pi/ExternalSSD/%s.caf' % \
-                self.record_file = '/home/pi/recordings/%s.caf' % \
-                        datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
-                print(self.record_file)
-                self.rec_proc = subprocess.Popen(self.record_command + \
-                        [self.record_file], env=self.my_env)
-                print(self.record_command + \
-                        [self.record_file])
-#                except OSError:
-#                    print("Error")
-#                    if self.rec_proc is not None:
-#                       self.rec_proc.terminate()
-        else:
-            print("stopping")
-            if self.rec_proc != 0:
-                self.rec_proc.terminate()
+        "start or stop recording the USB audio, the buffer and disk counters show on the button"
+        if state:
+            if self.recorder is not None:
+                return
+            from lib.recorder import Recorder, make_source
+            prefix = os.path.join(self.record_dir,
+                                  datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S"))
+            try:
+                recorder = Recorder(make_source(self.record_source), prefix,
+                                    tracks=self.record_tracks)
+                recorder.start()
+            except OSError as error:
+                print("Recording failed: %s" % error)
+                return
+            print("Recording to %s" % prefix)
+            self.recorder = recorder
+            self.record_event = Clock.schedule_interval(self.show_recording, 0.5)
+        elif self.recorder is not None:
+            self.record_event.cancel()
+            self.recorder.stop()
+            (seconds, fill, peak, rate, overruns) = self.recorder.status()
+            print("Recorded %.1f s, peak buffer %d%%, %d overruns" % (seconds, peak * 100,
+                                                                       overruns))
+            self.recorder = None
+            self.ids.record_button.text = "Record"
+
+    def show_recording(self, dt):
+        if not self.recorder.capturing:     # the device went away
+            self.record(False)
+            return
+        (seconds, fill, peak, rate, overruns) = self.recorder.status()
+        self.ids.record_button.text = "Rec %d:%02d xrun %d\nbuf %d%% %.1fMB/s" % (
+            seconds // 60, seconds % 60, overruns, fill * 100, rate)
 
     def quit(self):
         self.quit_called = True
+        if stats.counters or stats.histograms:
+            stats.dump(self.stats_file)
+        if self.mixer_state is not None:
+            self.mixer_state.save(self.state_file)
+        if self.shared is not None:
+            if self.xair_client is not None:
+                self.xair_client.stop_server()
+                self.xair_client = None
+            self.ballistics = None      # holds a view of the shared meters
+            self.shared.close()
         try:
-            if self.rec_proc != 0:
-                self.rec_proc.terminate()
+            if self.recorder is not None:
+                self.recorder.stop()
             if self.xair_client is not None:
                 self.xair_client.stop_server()
                 self.xair_client = None
@@ -360,13 +550,71 @@ class XRemGUI(Widget):
 
 
 class Xrem(App):
+    def __init__(self, options, **kwargs):
+        super().__init__(**kwargs)
+        self.options = options
+
     def build(self):
         Window.top = 0
         Window.left = 0
         self.GUI = XRemGUI()
-        self.GUI.paint_buttons()
+        startup.mark('build gui')
+        self.GUI.profile_startup = self.options.profile_startup
+        self.GUI.capture_file = self.options.capture
+        self.GUI.replay_file = self.options.replay
+        self.GUI.replay_speed = self.options.speed
+        self.GUI.use_ballistics = not self.options.no_ballistics
+        self.GUI.use_worker = self.options.worker
+        self.GUI.record_source = self.options.record_source
+        self.GUI.record_tracks = self.options.record_tracks
+        if self.options.record_dir is not None:
+            self.GUI.record_dir = self.options.record_dir
+        if self.options.mixer is not None:
+            (host, _, port) = self.options.mixer.partition(':')
+            self.GUI.xair_address = host
+            if port:
+                self.GUI.xair_port = int(port)
+        if self.options.stats is not None:
+            self.GUI.stats_file = self.options.stats
+            self.GUI.ids.stats_button.state = "down"
+        self.GUI.paint_buttons(meter_bridge=self.options.meter_bridge, incremental=True)
+        Window.bind(on_flip=self.first_frame)
         return self.GUI
 
+    def first_frame(self, window):
+        startup.mark('first frame')
+        window.unbind(on_flip=self.first_frame)
+        self.GUI.warm_up()
+
+
+def parse_args():
+    "application options, given after -- to keep them apart from the kivy options"
+    parser = argparse.ArgumentParser(description='Meter display for XAir mixers')
+    parser.add_argument('--meter-bridge', action='store_true',
+                        help='draw the strips from a single canvas instead of widgets')
+    parser.add_argument('--mixer', metavar='HOST[:PORT]',
+                        help='connect to this mixer or relay instead of searching the network')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='append the OSC datagrams received from the mixer to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='play an OSC capture on connect instead of using a mixer')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed as a multiple of the original, 0 for flat out')
+    parser.add_argument('--no-ballistics', action='store_true',
+                        help='show each meter value as received without smoothing or peak hold')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='collect performance counters from the start, written to FILE on quit')
+    parser.add_argument('--worker', action='store_true',
+                        help='run the mixer connection and OSC decoding in a separate process')
+    parser.add_argument('--record-dir', metavar='DIR', help='directory the recordings are written to')
+    parser.add_argument('--record-source', default='alsa', metavar='SOURCE',
+                        help='record alsa, the mixer USB audio, synthetic tones or a raw or WAV file')
+    parser.add_argument('--record-tracks', action='store_true',
+                        help='record a mono file per channel instead of one file of all channels')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='log how long each phase of start up takes')
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
-    Xrem().run()
\ No newline at end of file
+    Xrem(parse_args()).run()
\ No newline at end of file